@@ -0,0 +1,178 @@
+"""
+Off-screen asset atlas for the ulcd43pct Display class.
+
+Assets such as icons and button faces are rendered once into a page that is
+not displayed, and then stamped onto the visible page with a single
+gfx_ScreenCopyPaste:
+
+    atlas = Atlas(display)
+    def render(display, (x, y)):
+        display.gfx_CircleFilled((x + 15, y + 15), 15, 0xf800)
+    with atlas.stamping():
+        for point in points:
+            atlas.stamp('dot', (31, 31), render, point)
+
+Space on the atlas page is allocated in shelves. When it runs out, the
+least recently stamped assets are evicted.
+"""
+
+import collections
+import contextlib
+
+
+class Shelf(object):
+    """
+    A horizontal strip of the atlas page, filled from left to right.
+    Space freed by evicted assets is reused.
+    """
+
+    def __init__(self, y, height):
+        self.y = y
+        self.height = height
+        self.slots = []
+
+    def free(self, width, limit):
+        """
+        Return the leftmost x of a free width pixels before limit, or None.
+        """
+        x = 0
+        for start, size, key in sorted(self.slots):
+            if start - x >= width:
+                return x
+            x = max(x, start + size)
+        if limit - x >= width:
+            return x
+        return None
+
+
+class Atlas(object):
+    """
+    Cache of rendered assets on page of display, which are stamped onto
+    visible_page. size is the (width, height) of the page area used,
+    defaulting to the screen.
+    """
+
+    def __init__(self, display, page=1, visible_page=0, size=None):
+        self.display = display
+        self.page = page
+        self.visible_page = visible_page
+        self.size = size or (display.RES_X, display.RES_Y)
+        self.shelves = []
+        self.entries = collections.OrderedDict()
+        self.read_page = None
+        self.write_page = None
+        self.active = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def set_pages(self, read_page, write_page):
+        """
+        Select the read and write pages, sending only what changed.
+        """
+        if read_page != self.read_page:
+            self.display.gfx_Set(self.display.GFX_SET_PAGE_READ, read_page)
+            self.read_page = read_page
+        if write_page != self.write_page:
+            self.display.gfx_Set(self.display.GFX_SET_PAGE_WRITE, write_page)
+            self.write_page = write_page
+
+    def find(self, width, height):
+        """
+        Return the shelf and x of a free width x height area, or None.
+        Prefers the shelf wasting the least height, then a new shelf.
+        """
+        best = None
+        for shelf in self.shelves:
+            if shelf.height >= height and (best is None or shelf.height < best[0].height):
+                x = shelf.free(width, self.size[0])
+                if x is not None:
+                    best = (shelf, x)
+        if best is None:
+            y = self.shelves[-1].y + self.shelves[-1].height if self.shelves else 0
+            if y + height > self.size[1] or width > self.size[0]:
+                return None
+            best = (Shelf(y, height), 0)
+            self.shelves.append(best[0])
+        return best
+
+    def allocate(self, key, width, height):
+        """
+        Allocate an area for key, evicting least recently used assets until
+        one is found.
+        """
+        while True:
+            found = self.find(width, height)
+            if found:
+                break
+            if not self.entries:
+                raise Exception('Asset of %dx%d does not fit in the atlas' % (width, height))
+            self.evict(next(iter(self.entries)))
+        shelf, x = found
+        shelf.slots.append((x, width, key))
+        return (x, shelf.y, width, height)
+
+    def evict(self, key):
+        x, y, width, height = self.entries.pop(key)
+        for shelf in self.shelves:
+            shelf.slots = [slot for slot in shelf.slots if slot[2] != key]
+        # Empty shelves at the bottom give their height back
+        while self.shelves and not self.shelves[-1].slots:
+            self.shelves.pop()
+        self.counters['evictions'] += 1
+
+    def rectangle(self, key, size, render):
+        """
+        Return the (x, y, width, height) of key on the atlas page,
+        rendering it with render(display, origin) if it is not there.
+        Assets are rendered unclipped, and the clip state is restored for
+        the copy.
+        """
+        if key in self.entries:
+            self.counters['hits'] += 1
+            rectangle = self.entries.pop(key)
+        else:
+            self.counters['misses'] += 1
+            rectangle = self.allocate(key, *size)
+            self.set_pages(self.read_page, self.page)
+            clipping, clip_window = self.display.clipping, self.display.clip_window
+            self.display.set_clip(None)
+            render(self.display, rectangle[:2])
+            self.display.restore_clip(clipping, clip_window)
+        self.entries[key] = rectangle
+        return rectangle
+
+    def stamp(self, key, size, render, point):
+        """
+        Copy the asset key, of size (width, height), to point on the
+        visible page.
+        """
+        if not self.active:
+            with self.stamping():
+                return self.stamp(key, size, render, point)
+        x, y, width, height = self.rectangle(key, size, render)
+        self.set_pages(self.page, self.visible_page)
+        return self.display.gfx_ScreenCopyPaste((x, y), point, width, height)
+
+    @contextlib.contextmanager
+    def stamping(self):
+        """
+        Context manager for a run of stamps. Page selections are only sent
+        when they change, and both pages are restored to the visible page
+        at the end.
+        """
+        self.active += 1
+        try:
+            with self.display.batch():
+                try:
+                    yield self
+                finally:
+                    if self.active == 1:
+                        self.set_pages(self.visible_page, self.visible_page)
+        finally:
+            self.active -= 1
+            if not self.active:
+                # Others may change the pages between runs
+                self.read_page = self.write_page = None
@@ -0,0 +1,407 @@
+"""
+Share one ulcd43pct display between several processes.
+
+BridgeServer owns a Display and accepts connections from local clients over
+TCP or Unix sockets. BridgeDisplay is a Display whose commands are sent to a
+bridge server instead of a serial port.
+
+Clients send frames of commands, and the server answers each frame with a
+frame of replies. Both kinds of frame are a header of payload length and
+entry count, followed by the entries. A request entry is the reply type,
+extra execution time in milliseconds and length of a command followed by its
+bytes; a reply entry is a status and length followed by the reply payload
+that came after the ACK.
+"""
+
+import Queue
+import collections
+import os
+import socket
+import struct
+import threading
+
+import ulcd43pct as lcd
+
+FRAME_HEADER = struct.Struct('>IH')
+REQUEST_HEADER = struct.Struct('>BIH')
+REPLY_HEADER = struct.Struct('>BH')
+
+STATUS_OK = 0
+STATUS_ERR = 1
+STATUS_FAILED = 2
+
+MAX_ENTRIES = 0xffff
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def read_frame(sock, header):
+    """
+    Read a frame from sock, returning a list of entries, each a tuple of the
+    fields of header but the length, followed by the data.
+    """
+    length, count = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    payload = recv_exactly(sock, length)
+    entries = []
+    offset = 0
+    for i in xrange(count):
+        fields = header.unpack_from(payload, offset)
+        offset += header.size
+        entries.append(fields[:-1] + (payload[offset:offset+fields[-1]],))
+        offset += fields[-1]
+    return entries
+
+
+def write_frame(sock, entries, header):
+    """
+    Write a list of entries, as returned by read_frame(), to sock as one
+    frame.
+    """
+    payload = ''.join(header.pack(*entry[:-1] + (len(entry[-1]),)) + entry[-1] for entry in entries)
+    sock.sendall(FRAME_HEADER.pack(len(payload), len(entries)) + payload)
+
+
+def encode_reply(reply, result):
+    if reply == lcd.Display.REPLY_ACK:
+        return ''
+    if reply == lcd.Display.REPLY_WORD:
+        return struct.pack('>H', result)
+    if reply == lcd.Display.REPLY_WORDS:
+        return struct.pack('>HH', *result)
+    return result
+
+
+def decode_reply(reply, data):
+    if reply == lcd.Display.REPLY_ACK:
+        return True
+    if reply == lcd.Display.REPLY_WORD:
+        return struct.unpack('>H', data)[0]
+    if reply == lcd.Display.REPLY_WORDS:
+        return struct.unpack('>HH', data)
+    return data
+
+
+def create_socket(address):
+    """
+    Create a socket for address: a filesystem path for a Unix socket, or a
+    (host, port) tuple for TCP.
+    """
+    if isinstance(address, basestring):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class Frame(object):
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.results = [None] * len(entries)
+        self.taken = 0
+        self.done = 0
+
+
+class Session(object):
+    """
+    Server side of one client connection. Frames are read by one thread,
+    and replies written by another from the outbox, so a client that is
+    slow to read its replies only holds up itself.
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.frames = collections.deque()
+        self.outbox = Queue.Queue()
+        self.threads = [threading.Thread(target=self.run), threading.Thread(target=self.send)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        try:
+            while True:
+                self.server.enqueue(self, Frame(read_frame(self.sock, REQUEST_HEADER)))
+        except (EOFError, socket.error):
+            pass
+        self.server.disconnect(self)
+
+    def send(self):
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                break
+            try:
+                write_frame(self.sock, frame.results, REPLY_HEADER)
+            except socket.error:
+                break
+
+    def take(self, quantum):
+        """
+        Take the commands of whole queued frames, in order, up to quantum
+        commands unless the first frame alone has more. A frame is never
+        split, so the commands of one client batch() run without commands
+        of other clients in between.
+        """
+        commands = []
+        for frame in self.frames:
+            if frame.taken == len(frame.entries):
+                continue
+            if commands and len(commands) + len(frame.entries) > quantum:
+                break
+            commands.extend((frame, index) for index in xrange(len(frame.entries)))
+            frame.taken = len(frame.entries)
+        return commands
+
+    def reply(self):
+        """
+        Queue the replies of all frames whose commands have completed.
+        """
+        while self.frames and self.frames[0].done == len(self.frames[0].entries):
+            self.outbox.put(self.frames.popleft())
+
+
+class BridgeServer(object):
+    """
+    Serves one Display to many clients. Commands of all clients are merged
+    into one stream, taking whole frames of up to QUANTUM commands from each
+    client in turn, so that no client can starve the others. Each client's
+    commands run in the order they were sent, and ACK-only commands are
+    pipelined with Display.batch().
+    """
+
+    QUANTUM = 16
+
+    def __init__(self, display, address):
+        self.display = display
+        self.address = address
+        self.sock = None
+        self.sessions = []
+        self.lock = threading.Condition()
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.sock = create_socket(self.address)
+        if not isinstance(self.address, basestring):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(8)
+        self.running = True
+        for target in (self.accept, self.execute):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return True
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.unlink(self.address)
+        for session in list(self.sessions):
+            session.outbox.put(None)
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            for thread in session.threads:
+                thread.join()
+        return True
+
+    def serve_forever(self):
+        self.start()
+        while self.running:
+            self.threads[-1].join(1)
+
+    def accept(self):
+        while self.running:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                break
+            session = Session(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+            session.start()
+
+    def enqueue(self, session, frame):
+        with self.lock:
+            session.frames.append(frame)
+            # Empty frames complete at once
+            session.reply()
+            self.lock.notify()
+
+    def disconnect(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        session.outbox.put(None)
+        session.sock.close()
+
+    def schedule(self):
+        """
+        Block until there is work, and return the next round of commands.
+        """
+        with self.lock:
+            while self.running:
+                commands = []
+                for session in self.sessions:
+                    commands.extend((session, frame, index) for frame, index in session.take(self.QUANTUM))
+                if commands:
+                    return commands
+                self.lock.wait(1)
+        return []
+
+    def execute(self):
+        while self.running:
+            self.execute_round(self.schedule())
+
+    def execute_round(self, commands):
+        """
+        Run a round of commands returned by schedule(), and queue the
+        replies of the frames it completes.
+        """
+        deferred = []
+        with self.display.batch():
+            for session, frame, index in commands:
+                kind, delay, command = frame.entries[index]
+                # An ERR must not be charged to the commands of another frame
+                if deferred and (kind != self.display.REPLY_ACK or deferred[-1][0] is not frame):
+                    self.complete(deferred)
+                if kind == self.display.REPLY_ACK:
+                    deferred.append((frame, index))
+                status = STATUS_OK
+                try:
+                    result = self.display.transact(command, kind, delay=delay / 1000.0)
+                except lcd.ProtocolError:
+                    status = STATUS_FAILED
+                except Exception:
+                    status = STATUS_ERR
+                if kind != self.display.REPLY_ACK:
+                    data = encode_reply(kind, result) if status == STATUS_OK else ''
+                    self.finish(frame, index, status, data)
+                elif status != STATUS_OK or not self.display.pending:
+                    # The write buffer filled up, and was flushed with the
+                    # rest of the deferred commands
+                    self.settle(deferred, status)
+            self.complete(deferred)
+        with self.lock:
+            for session in set(session for session, frame, index in commands):
+                session.reply()
+
+    def complete(self, deferred):
+        """
+        Check the ACKs of deferred commands. An ERR is reported to all
+        deferred commands, since it cannot be attributed further.
+        """
+        status = STATUS_OK
+        try:
+            self.display.flush()
+        except lcd.ProtocolError:
+            status = STATUS_FAILED
+        except Exception:
+            status = STATUS_ERR
+        self.settle(deferred, status)
+
+    def settle(self, deferred, status):
+        for frame, index in deferred:
+            self.finish(frame, index, status, '')
+        del deferred[:]
+
+    def finish(self, frame, index, status, data):
+        frame.results[index] = (status, data)
+        frame.done += 1
+
+
+class BridgeDisplay(lcd.Display):
+    """
+    A Display proxy which sends its commands to a BridgeServer. Inside
+    batch(), ACK-only commands are sent together in one frame, which the
+    server runs without commands of other clients in between. A command
+    that needs its reply ends the frame.
+    """
+
+    def __init__(self, address):
+        super(BridgeDisplay, self).__init__()
+        self.address = address
+        self.sock = None
+        self.queued = []
+
+    def connect(self):
+        if self.sock:
+            raise Exception("Bridge already connected.")
+        self.sock = create_socket(self.address)
+        self.sock.connect(self.address)
+        return True
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+        self.sock = None
+        return True
+
+    def reset(self):
+        return True
+
+    def transact(self, buf, reply=lcd.Display.REPLY_ACK, idempotent=None, delay=0, retries=None):
+        buf = str(self.command + buf)
+        self.command = bytearray()
+        self.queued.append((reply, int(round(delay * 1000)), buf))
+        if self.batching and reply == self.REPLY_ACK and len(self.queued) < MAX_ENTRIES:
+            return True
+        return self.exchange()
+
+    def flush(self):
+        if self.command:
+            self.transact('')
+        if self.queued:
+            self.exchange()
+        return True
+
+    def exchange(self):
+        """
+        Send the queued commands and return the result of the last one.
+        """
+        queued = self.queued
+        self.queued = []
+        write_frame(self.sock, queued, REQUEST_HEADER)
+        replies = read_frame(self.sock, REPLY_HEADER)
+        errors = sum(1 for status, data in replies if status == STATUS_ERR)
+        if any(status == STATUS_FAILED for status, data in replies):
+            raise lcd.ProtocolError('Bridge lost framing with the display')
+        if errors:
+            raise Exception('Command error, received ERR for %d commands' % errors)
+        return decode_reply(queued[-1][0], replies[-1][1])
+
+    def set_clip(self, window):
+        # Other clients may change the clip state between our commands.
+        self.clipping = None
+        self.clip_window = None
+        return super(BridgeDisplay, self).set_clip(window)
+
+    def setbaudWait(self, baudrate):
+        raise Exception('The baud rate is owned by the bridge server.')
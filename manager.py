@@ -0,0 +1,189 @@
+"""
+Drive several ulcd43pct displays concurrently.
+"""
+
+import Queue
+import threading
+
+import ulcd43pct as lcd
+
+
+class DisplayList(object):
+    """
+    A recorded sequence of Display method calls, which can be replayed on any
+    number of displays. Calls are recorded by calling the Display methods
+    on the list itself:
+
+        dl = DisplayList()
+        dl.gfx_Cls()
+        dl.gfx_RectangleFilled((0, 0), (99, 99), 0xf800)
+    """
+
+    def __init__(self, commands=None):
+        self.commands = list(commands or [])
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(lcd.Display, name, None)):
+            raise AttributeError(name)
+        def record(*args):
+            self.commands.append((name, args))
+            return True
+        return record
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def replay(self, display):
+        """
+        Execute all recorded calls on display in one batch, returning a list
+        of results.
+        """
+        with display.batch():
+            return [getattr(display, name)(*args) for name, args in self.commands]
+
+
+class Job(object):
+    """
+    A unit of work queued for a display worker.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job has run, then return its result or raise its
+        exception.
+        """
+        if not self.done.wait(timeout):
+            raise Exception('Timed out waiting for display job')
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class DisplayWorker(threading.Thread):
+    """
+    Thread owning one Display, executing queued jobs in order.
+
+    Serial I/O blocks in the operating system with the interpreter lock
+    released, so one worker per port lets every port run at its full rate
+    regardless of how many panels there are.
+    """
+
+    def __init__(self, display):
+        super(DisplayWorker, self).__init__()
+        self.daemon = True
+        self.display = display
+        self.queue = Queue.Queue()
+
+    def submit(self, func, *args):
+        job = Job(func, *args)
+        self.queue.put(job)
+        return job
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.run()
+
+
+class DisplayManager(object):
+    """
+    Owns several Display instances on different serial ports, and pipelines
+    work to each of them independently. All methods return Job objects
+    immediately; call wait() on them to collect results.
+    """
+
+    def __init__(self, displays=()):
+        self.workers = {}
+        self.names = []
+        for display in displays:
+            self.add(display)
+
+    def add(self, display, name=None):
+        """
+        Add a display under name, which defaults to its serial port, or to
+        its position for displays on other transports.
+        """
+        if name is None:
+            name = display.serial_port or 'display%d' % len(self.names)
+        if name in self.workers:
+            raise Exception("Display '%s' already added" % name)
+        worker = DisplayWorker(display)
+        worker.start()
+        self.workers[name] = worker
+        self.names.append(name)
+        return worker
+
+    def display(self, name):
+        return self.workers[name].display
+
+    def submit(self, name, func, *args):
+        """
+        Queue func(display, *args) on the worker of the named display.
+        """
+        worker = self.workers[name]
+        return worker.submit(func, worker.display, *args)
+
+    def call(self, name, method, *args):
+        """
+        Queue a call of the named Display method.
+        """
+        return self.submit(name, lambda display, *args: getattr(display, method)(*args), *args)
+
+    def draw(self, name, display_list):
+        """
+        Queue a DisplayList for replay on the named display.
+        """
+        return self.submit(name, display_list.replay)
+
+    def broadcast(self, display_list, names=None):
+        """
+        Queue a DisplayList for replay on several displays, all of them by
+        default. Returns a list of jobs, in the order of names.
+        """
+        return [self.draw(name, display_list) for name in (names or self.names)]
+
+    def connect(self):
+        return self.wait([self.call(name, 'connect') for name in self.names])
+
+    def close(self):
+        """
+        Close all displays and stop their workers.
+        """
+        jobs = [self.call(name, 'close') for name in self.names]
+        for name in self.names:
+            self.workers[name].stop()
+        self.wait(jobs)
+        for name in self.names:
+            self.workers[name].join()
+        self.workers = {}
+        self.names = []
+        return True
+
+    @staticmethod
+    def wait(jobs, timeout=None):
+        """
+        Wait for all jobs and return their results, in order.
+        """
+        return [job.wait(timeout) for job in jobs]
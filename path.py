@@ -0,0 +1,204 @@
+"""
+Vector paths for the ulcd43pct Display class.
+
+A Path is built from moves, lines, quadratic and cubic Bezier curves and
+circular arcs. Drawing it flattens the curves to integer vertices within a
+pixel tolerance, and sends each subpath with its cheapest encoding:
+
+    p = path.Path()
+    p.move_to((10, 10))
+    p.curve_to((60, 0), (100, 80), (150, 40))
+    p.arc((200, 100), 40, 0, 270)
+    p.draw(display, 0xffff)
+
+Compiled paths are cached per shape, transform and tolerance.
+"""
+
+import collections
+import math
+
+import peephole
+import ulcd43pct as lcd
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+CACHE_SIZE = 256
+CACHE = collections.OrderedDict()
+
+
+def apply(transform, point):
+    """
+    Apply the affine transform (a, b, c, d, e, f) to point, mapping (x, y)
+    to (a*x + c*y + e, b*x + d*y + f).
+    """
+    a, b, c, d, e, f = transform
+    x, y = point
+    return (a * x + c * y + e, b * x + d * y + f)
+
+
+def scale(transform):
+    """
+    Return an upper bound of how much transform stretches distances.
+    """
+    a, b, c, d, e, f = transform
+    return max(math.hypot(a, b), math.hypot(c, d), 1e-9)
+
+
+def segments(deviation, tolerance):
+    """
+    Return the number of uniform segments needed to keep a curve whose
+    second derivative is bounded by deviation within tolerance.
+    """
+    return max(int(math.ceil(math.sqrt(deviation / (8.0 * tolerance)))), 1)
+
+
+class Path(object):
+    """
+    A sequence of subpaths. Angles of arcs are in degrees, clockwise from
+    the positive x axis, as for gfx_Orbit.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def key(self):
+        return tuple(self.commands)
+
+    def move_to(self, point):
+        self.commands.append(('move', tuple(point)))
+        return self
+
+    def line_to(self, point):
+        self.commands.append(('line', tuple(point)))
+        return self
+
+    def quad_to(self, control, point):
+        self.commands.append(('quad', tuple(control), tuple(point)))
+        return self
+
+    def curve_to(self, control1, control2, point):
+        self.commands.append(('curve', tuple(control1), tuple(control2), tuple(point)))
+        return self
+
+    def arc(self, centre, radius, start, end):
+        """
+        Add an arc from angle start to end. Like on a canvas, a line joins
+        the current point to the start of the arc.
+        """
+        self.commands.append(('arc', tuple(centre), radius, start, end))
+        return self
+
+    def close(self):
+        self.commands.append(('close',))
+        return self
+
+    def flatten(self, tolerance=0.5, transform=IDENTITY):
+        """
+        Return the subpaths as lists of transformed points, with curves
+        approximated by lines deviating at most tolerance pixels from them.
+        """
+        subpaths = []
+        points = []
+        for command in self.commands:
+            kind = command[0]
+            if kind == 'move':
+                if points:
+                    subpaths.append(points)
+                points = [apply(transform, command[1])]
+            elif kind == 'line':
+                points.append(apply(transform, command[1]))
+            elif kind == 'close':
+                if points:
+                    points.append(points[0])
+                    subpaths.append(points)
+                points = []
+            elif kind == 'arc':
+                points.extend(self.flatten_arc(command[1:], tolerance, transform))
+            else:
+                if not points:
+                    raise Exception('Curve without a current point')
+                controls = [points[-1]] + [apply(transform, point) for point in command[1:]]
+                points.extend(self.flatten_bezier(controls, tolerance))
+        if points:
+            subpaths.append(points)
+        return subpaths
+
+    def flatten_bezier(self, controls, tolerance):
+        """
+        Flatten a quadratic or cubic Bezier curve given by its control
+        points, returning the points after the first.
+        """
+        second = [(controls[i][0] - 2 * controls[i+1][0] + controls[i+2][0],
+                controls[i][1] - 2 * controls[i+1][1] + controls[i+2][1]) for i in xrange(len(controls) - 2)]
+        degree = len(controls) - 1
+        deviation = degree * (degree - 1) * max(math.hypot(x, y) for x, y in second)
+        n = segments(deviation, tolerance)
+        points = []
+        for i in xrange(1, n + 1):
+            t = float(i) / n
+            level = controls
+            while len(level) > 1:
+                level = [(a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t) for a, b in zip(level, level[1:])]
+            points.append(level[0])
+        return points
+
+    def flatten_arc(self, arc, tolerance, transform):
+        (x, y), radius, start, end = arc
+        tolerance = tolerance / scale(transform)
+        if radius <= tolerance:
+            step = abs(end - start) or 1
+        else:
+            step = math.degrees(2 * math.acos(1 - tolerance / float(radius)))
+        n = max(int(math.ceil(abs(end - start) / step)), 1)
+        points = []
+        for i in xrange(n + 1):
+            angle = math.radians(start + (end - start) * float(i) / n)
+            points.append(apply(transform, (x + radius * math.cos(angle), y + radius * math.sin(angle))))
+        return points
+
+    def compile(self, tolerance=0.5, transform=IDENTITY):
+        """
+        Return the subpaths as lists of integer vertices, without repeated
+        vertices. Results are cached.
+        """
+        key = (self.key(), tuple(transform), tolerance)
+        if key in CACHE:
+            vertices = CACHE.pop(key)
+        else:
+            vertices = []
+            for points in self.flatten(tolerance, transform):
+                snapped = [(int(round(x)), int(round(y))) for x, y in points]
+                vertices.append([point for i, point in enumerate(snapped) if not i or point != snapped[i-1]])
+            if len(CACHE) >= CACHE_SIZE:
+                CACHE.popitem(last=False)
+        CACHE[key] = vertices
+        return vertices
+
+    def draw(self, display, colour, tolerance=0.5, transform=IDENTITY):
+        """
+        Draw the path in colour. Returns the commands sent.
+        """
+        commands = []
+        for vertices in self.compile(tolerance, transform):
+            commands.extend(encode(vertices, colour))
+        for name, args in commands:
+            getattr(display, name)(*args)
+        return commands
+
+
+def encode(vertices, colour):
+    """
+    Return the cheapest command sequence drawing the polyline through
+    vertices: a pixel, a single gfx_Line, a gfx_Polyline, or gfx_LineTo
+    from the cursor set by gfx_MoveTo.
+    """
+    if len(vertices) == 1:
+        return [('gfx_PutPixel', (vertices[0], colour))]
+    candidates = [
+        [('gfx_Polyline', (colour,) + tuple(vertices))],
+        [('gfx_Set', (lcd.Display.GFX_SET_OBJECT_COLOUR, colour)), ('gfx_MoveTo', (vertices[0],))]
+                + [('gfx_LineTo', (vertex,)) for vertex in vertices[1:]],
+    ]
+    if len(vertices) == 2:
+        candidates.append([('gfx_Line', (vertices[0], vertices[1], colour))])
+    return min(candidates, key=lambda commands: sum(peephole.cost(command) for command in commands))
@@ -0,0 +1,265 @@
+"""
+Peephole optimizer for queued Display commands.
+
+Works on lists of (method name, arguments) tuples, as recorded by
+manager.DisplayList, and removes commands that cannot change what ends up on
+the screen:
+
+* drawing that is completely covered by a later gfx_Cls or opaque
+  gfx_RectangleFilled, with nothing in between that reads pixels or changes
+  where drawing lands;
+* adjacent gfx_RectangleFilled of the same colour, merged into one;
+* gfx_MoveTo followed by another gfx_MoveTo before the cursor is used;
+* state changes that set a value already in effect.
+
+Removed state changes no longer return the previous value, so results of an
+optimized list should not be relied upon. Savings are measured with the
+exact encoding of each command; simulator.Device can serve as the reference
+rasterizer to check that an optimized list draws the same picture.
+"""
+
+import ulcd43pct as lcd
+
+# Drawing commands whose only effect is on pixels inside their bounding box.
+DRAWING = frozenset([
+    'gfx_Circle', 'gfx_CircleFilled', 'gfx_Line', 'gfx_Rectangle',
+    'gfx_RectangleFilled', 'gfx_Polyline', 'gfx_Polygon', 'gfx_PolygonFilled',
+    'gfx_Triangle', 'gfx_TriangleFilled', 'gfx_PutPixel', 'gfx_Ellipse',
+    'gfx_EllipseFilled',
+])
+
+# State changes whose argument fully determines the resulting state.
+SETTERS = frozenset([
+    'txt_FGcolour', 'txt_BGcolour', 'txt_FontID', 'txt_Width', 'txt_Height',
+    'txt_Xgap', 'txt_Ygap', 'txt_Bold', 'txt_Inverse', 'txt_Italic',
+    'txt_Opacity', 'txt_Underline', 'txt_Attributes', 'gfx_Clipping',
+    'gfx_ClipWindow', 'gfx_BevelShadow', 'gfx_BevelWidth',
+    'gfx_BackgroundColour', 'gfx_OutlineColour', 'gfx_Contrast',
+    'gfx_FrameDelay', 'gfx_LinePattern', 'gfx_ScreenMode', 'gfx_Transparency',
+    'gfx_TransparentColour', 'gfx_Set',
+])
+
+# Commands that do not read pixels, nor change where or whether later drawing
+# lands. Covered drawing can be removed across them.
+TRANSPARENT = DRAWING | frozenset([
+    'txt_MoveCursor', 'putCH', 'putStr', 'charwidth', 'charheight',
+    'txt_FGcolour', 'txt_BGcolour', 'txt_FontID', 'txt_Width', 'txt_Height',
+    'txt_Xgap', 'txt_Ygap', 'txt_Bold', 'txt_Inverse', 'txt_Italic',
+    'txt_Opacity', 'txt_Underline', 'txt_Attributes', 'gfx_Cls',
+    'gfx_MoveTo', 'gfx_LineTo', 'gfx_Orbit', 'gfx_BevelShadow',
+    'gfx_BevelWidth', 'gfx_BackgroundColour', 'gfx_OutlineColour',
+    'gfx_Contrast', 'gfx_FrameDelay', 'gfx_LinePattern', 'gfx_Button',
+    'gfx_Panel', 'gfx_Slider',
+])
+
+# Commands that neither use nor move the graphics cursor.
+CURSOR_NEUTRAL = DRAWING | SETTERS
+
+# State changed by commands other than its own setter, keyed like
+# setter_key(). On PICASO, gfx_Cls restores several defaults, which the
+# simulator does not model. Commands in neither SETTERS nor TRANSPARENT, and
+# not listed here, may change any state.
+TEXT_ATTRIBUTES = ('txt_Bold', 'txt_Italic', 'txt_Inverse', 'txt_Underline')
+RESETS = {
+    'gfx_Cls': [('gfx_OutlineColour',), ('gfx_Transparency',), ('gfx_LinePattern',),
+        ('txt_Opacity',), ('txt_Width',), ('txt_Height',)],
+    'gfx_SetClipRegion': [('gfx_ClipWindow',)],
+    'gfx_ScreenCopyPaste': [],
+    'gfx_GetPixel': [],
+    'txt_Attributes': [(name,) for name in TEXT_ATTRIBUTES],
+}
+for name in TEXT_ATTRIBUTES:
+    RESETS[name] = [('txt_Attributes',)]
+
+
+class Meter(lcd.Display):
+    """
+    A Display that only counts the bytes its commands would send and
+    receive.
+    """
+
+    def __init__(self):
+        super(Meter, self).__init__()
+        self.size = 0
+
+    def transact(self, buf, reply=lcd.Display.REPLY_ACK, idempotent=None, delay=0, retries=None):
+        self.size += len(self.command) + len(buf) + self.REPLY_SIZES[reply]
+        self.command = bytearray()
+        if reply == self.REPLY_WORDS:
+            return (0, 0)
+        if reply == self.REPLY_STRING:
+            return ''
+        return 0 if reply == self.REPLY_WORD else True
+
+
+METER = Meter()
+
+
+def cost(command):
+    """
+    Return the number of bytes sent and received for command.
+    """
+    name, args = command
+    METER.size = 0
+    getattr(METER, name)(*args)
+    return METER.size
+
+
+def bounding_box(command):
+    """
+    Return the (x1, y1, x2, y2) box containing all pixels drawn by command.
+    """
+    name, args = command
+    if name in ('gfx_Circle', 'gfx_CircleFilled'):
+        (x, y), r = args[:2]
+        return (x - r, y - r, x + r, y + r)
+    if name in ('gfx_Ellipse', 'gfx_EllipseFilled'):
+        (x, y), xrad, yrad = args[:3]
+        return (x - xrad, y - yrad, x + xrad, y + yrad)
+    if name == 'gfx_PutPixel':
+        points = args[:1]
+    elif name in ('gfx_Polyline', 'gfx_Polygon', 'gfx_PolygonFilled'):
+        points = args[1:]
+    else:
+        points = [arg for arg in args if isinstance(arg, tuple)]
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def setter_key(command):
+    name, args = command
+    if name == 'gfx_Set':
+        return (name, args[0])
+    return (name,)
+
+
+def setter_value(command):
+    name, args = command
+    if name == 'gfx_Set':
+        return args[1]
+    if name in ('gfx_Clipping', 'gfx_Transparency', 'txt_Bold', 'txt_Inverse',
+            'txt_Italic', 'txt_Opacity', 'txt_Underline'):
+        return bool(args[0])
+    return args
+
+
+def remove_overdraw(commands, clipping=False, transparency=False):
+    """
+    Remove drawing covered by a later gfx_Cls, or by a later
+    gfx_RectangleFilled while clipping and transparency are off.
+    """
+    keep = [True] * len(commands)
+    for j, (name, args) in enumerate(commands):
+        if name == 'gfx_Clipping':
+            clipping = bool(args[0])
+        elif name == 'gfx_Transparency':
+            transparency = bool(args[0])
+        if name == 'gfx_Cls':
+            cover = None
+        elif name == 'gfx_RectangleFilled' and not clipping and not transparency:
+            cover = bounding_box(commands[j])
+        else:
+            continue
+        for i in xrange(j - 1, -1, -1):
+            if commands[i][0] not in TRANSPARENT:
+                break
+            if keep[i] and commands[i][0] in DRAWING and (cover is None or contains(cover, bounding_box(commands[i]))):
+                keep[i] = False
+    return [command for command, kept in zip(commands, keep) if kept]
+
+
+def merge_rectangles(commands, outline=0):
+    """
+    Merge consecutive same-coloured gfx_RectangleFilled whose union is a
+    rectangle. Only done while outlines are off.
+    """
+    result = []
+    for name, args in commands:
+        if name == 'gfx_OutlineColour':
+            outline = args[0]
+        if name == 'gfx_RectangleFilled' and not outline and result and result[-1][0] == name:
+            a = bounding_box(result[-1])
+            b = bounding_box((name, args))
+            if args[2] == result[-1][1][2]:
+                merged = None
+                if a[0] == b[0] and a[2] == b[2] and b[1] <= a[3] + 1 and a[1] <= b[3] + 1:
+                    merged = (a[0], min(a[1], b[1]), a[2], max(a[3], b[3]))
+                elif a[1] == b[1] and a[3] == b[3] and b[0] <= a[2] + 1 and a[0] <= b[2] + 1:
+                    merged = (min(a[0], b[0]), a[1], max(a[2], b[2]), a[3])
+                if merged:
+                    result[-1] = (name, (merged[:2], merged[2:], args[2]))
+                    continue
+        result.append((name, args))
+    return result
+
+
+def remove_dead_moves(commands):
+    """
+    Remove gfx_MoveTo that is followed by another gfx_MoveTo before anything
+    uses or moves the cursor.
+    """
+    result = []
+    for i, (name, args) in enumerate(commands):
+        if name == 'gfx_MoveTo':
+            following = [command for command in commands[i+1:] if command[0] not in CURSOR_NEUTRAL][:1]
+            if following and following[0][0] == 'gfx_MoveTo':
+                continue
+        result.append((name, args))
+    return result
+
+
+def remove_redundant_state(commands, state=None):
+    """
+    Remove state changes to the value already in effect. state is a
+    dictionary of the values known to be in effect before the first
+    command, keyed like setter_key(). State changed as a side effect of
+    other commands, see RESETS, is no longer known.
+    """
+    state = dict(state or {})
+    result = []
+    for command in commands:
+        name = command[0]
+        if name in SETTERS:
+            key = setter_key(command)
+            value = setter_value(command)
+            if key in state and state[key] == value:
+                continue
+            state[key] = value
+        elif name not in TRANSPARENT and name not in RESETS:
+            state.clear()
+        for key in RESETS.get(name, ()):
+            state.pop(key, None)
+        result.append(command)
+    return result
+
+
+def optimize(commands, clipping=False, transparency=False, outline=0, state=None):
+    """
+    Run all passes over commands until nothing changes. clipping,
+    transparency and outline describe the display state before the first
+    command. Returns the optimized commands and a report of bytes before
+    and after, bytes saved and commands removed.
+    """
+    commands = list(commands)
+    before = sum(cost(command) for command in commands)
+    count = len(commands)
+    while True:
+        previous = commands
+        commands = remove_redundant_state(commands, state)
+        commands = remove_dead_moves(commands)
+        commands = remove_overdraw(commands, clipping, transparency)
+        commands = merge_rectangles(commands, outline)
+        if commands == previous:
+            break
+    after = sum(cost(command) for command in commands)
+    return commands, {
+        'before': before,
+        'after': after,
+        'saved': before - after,
+        'removed': count - len(commands),
+    }
@@ -0,0 +1,354 @@
+"""
+Software model of a PICASO display, for use with transport.LoopbackTransport.
+
+The model parses the serial command stream the same way the device does and
+produces protocol-correct replies, so the library can be exercised and
+benchmarked without a physical display. It also serves as a reference
+rasterizer for rectangles, lines, polylines, pixels and screen copies,
+honouring the clip window.
+"""
+
+import array
+import math
+import struct
+
+from ulcd43pct import Display
+
+
+class Device(object):
+    """
+    Models the command interpreter of a uLCD-43PCT. Unknown opcodes are
+    answered with ERR and skipped one byte at a time; stray NUL bytes, such as
+    the ones sent by Display.reset(), are skipped silently.
+
+    The contents of each page are kept in pages, one RGB565 WORD per pixel;
+    framebuffer is the displayed page. Drawing goes to the write page, and
+    pixels are read and copied from the read page.
+    Primitives other than rectangles, lines, polylines and pixels are
+    accepted but not drawn.
+    """
+
+    MODEL = 'uLCD-43PT'
+    CHAR_WIDTH = 8
+    CHAR_HEIGHT = 12
+
+    # Argument formats
+    WORDS = 0
+    BYTE = 1
+    STRING = 2
+    POINTS = 3
+    BUTTON = 4
+
+    def __init__(self, width=480, height=272):
+        self.width = width
+        self.height = height
+        self.baudrate = 9600
+        self.rbuf = bytearray()
+        self.origin = (0, 0)
+        self.state = {}
+        self.clipping = False
+        self.clip_window = (0, 0, width - 1, height - 1)
+        self.object_colour = 0
+        self.touch_region = (0, 0, width - 1, height - 1)
+        self.touching = (Display.TOUCH_STATUS_NOTOUCH, 0, 0)
+        self.pages = {}
+        self.display_page = self.read_page = self.write_page = 0
+        self.counters = {
+            'commands': 0,
+            'errors': 0,
+        }
+        self.commands = self.command_table()
+
+    def command_table(self):
+        """
+        Return a dictionary of opcode: (argument format, argument count,
+        handler). Handlers receive the decoded arguments and return the
+        reply payload following the ACK.
+        """
+        d = Display
+        ack = lambda *args: ''
+        previous = self.previous
+        table = {
+            d.MOVE_CURSOR: (self.WORDS, 2, ack),
+            d.PUT_CH: (self.WORDS, 1, ack),
+            d.PUT_STR: (self.STRING, 0, lambda text: self.word(len(text))),
+            d.CHAR_WIDTH: (self.BYTE, 1, lambda char: self.word(self.CHAR_WIDTH)),
+            d.CHAR_HEIGHT: (self.BYTE, 1, lambda char: self.word(self.CHAR_HEIGHT)),
+            d.CLEAR_SCREEN: (self.WORDS, 0, self.clear_screen),
+            d.CHANGE_COLOUR: (self.WORDS, 2, ack),
+            d.CIRCLE: (self.WORDS, 4, ack),
+            d.CIRCLE_FILLED: (self.WORDS, 4, ack),
+            d.LINE: (self.WORDS, 5, self.line),
+            d.RECTANGLE: (self.WORDS, 5, self.rectangle),
+            d.RECTANGLE_FILLED: (self.WORDS, 5, self.rectangle_filled),
+            d.POLYLINE: (self.POINTS, 0, self.polyline),
+            d.POLYGON: (self.POINTS, 0, self.polygon),
+            d.POLYGON_FILLED: (self.POINTS, 0, ack),
+            d.TRIANGLE: (self.WORDS, 7, ack),
+            d.TRIANGLE_FILLED: (self.WORDS, 7, ack),
+            d.ORBIT: (self.WORDS, 2, self.orbit),
+            d.PUT_PIXEL: (self.WORDS, 3, self.put_pixel),
+            d.GET_PIXEL: (self.WORDS, 2, lambda x, y: self.word(self.pixel(x, y))),
+            d.MOVE_TO: (self.WORDS, 2, self.move_to),
+            d.LINE_TO: (self.WORDS, 2, self.line_to),
+            d.CLIPPING: (self.WORDS, 1, self.set_clipping),
+            d.CLIP_WINDOW: (self.WORDS, 4, self.set_clip_window),
+            d.SET_CLIP_REGION: (self.WORDS, 0, ack),
+            d.ELLIPSE: (self.WORDS, 5, ack),
+            d.ELLIPSE_FILLED: (self.WORDS, 5, ack),
+            d.BUTTON: (self.BUTTON, 8, ack),
+            d.PANEL: (self.WORDS, 6, ack),
+            d.SLIDER: (self.WORDS, 8, self.slider),
+            d.SCREEN_COPY_PASTE: (self.WORDS, 6, self.screen_copy_paste),
+            d.GFX_SET: (self.WORDS, 2, self.gfx_set),
+            d.GFX_GET: (self.WORDS, 1, self.gfx_get),
+            d.SET_BAUD_RATE: (self.WORDS, 1, self.set_baud_rate),
+            d.SLEEP: (self.WORDS, 1, lambda seconds: self.word(0)),
+            d.TOUCH_DETECT_REGION: (self.WORDS, 4, self.detect_region),
+            d.TOUCH_SET: (self.WORDS, 1, ack),
+            d.TOUCH_GET: (self.WORDS, 1, self.touch_get),
+            d.GET_DISPLAY_MODEL: (self.WORDS, 0, lambda: self.word(len(self.MODEL)) + self.MODEL),
+        }
+        for opcode in (d.TEXT_FGCOLOUR, d.TEXT_BGCOLOUR, d.TXT_FONT_ID,
+                d.TXT_WIDTH, d.TXT_HEIGHT, d.TXT_X_GAP, d.TXT_Y_GAP, d.TXT_BOLD,
+                d.TXT_INVERSE, d.TXT_ITALIC, d.TXT_OPACITY, d.TXT_UNDERLINE,
+                d.TXT_ATTRIBUTES, d.BEVEL_SHADOW, d.BEVEL_WIDTH,
+                d.BACKGROUND_COLOUR, d.OUTLINE_COLOUR, d.CONTRAST,
+                d.FRAME_DELAY, d.LINE_PATTERN, d.SCREEN_MODE, d.TRANSPARENCY,
+                d.TRANSPARENT_COLOUR):
+            table[opcode] = (self.WORDS, 1, lambda value, opcode=opcode: previous(opcode, value))
+        return table
+
+    def write(self, data):
+        """
+        Feed bytes received from the host, returning the reply bytes.
+        """
+        self.rbuf += data
+        replies = []
+        while len(self.rbuf) >= 2:
+            opcode = str(self.rbuf[:2])
+            if opcode not in self.commands:
+                if self.rbuf[0] != 0:
+                    self.counters['errors'] += 1
+                    replies.append(Display.ERR)
+                del self.rbuf[0]
+                continue
+            parsed = self.parse(opcode)
+            if parsed is None:
+                break
+            size, args = parsed
+            del self.rbuf[:size]
+            self.counters['commands'] += 1
+            replies.append(Display.ACK + self.commands[opcode][2](*args))
+        return ''.join(replies)
+
+    def parse(self, opcode):
+        """
+        Decode the arguments of the command at the start of the receive
+        buffer. Returns (command size, arguments), or None if the command is
+        not complete yet.
+        """
+        format, count, handler = self.commands[opcode]
+        buf = str(self.rbuf)
+        size = 2 + count * 2
+        if format == self.BYTE:
+            size = 3
+            if len(buf) < size:
+                return None
+            return size, (buf[2],)
+        if format == self.POINTS:
+            if len(buf) < 4:
+                return None
+            count = struct.unpack('>H', buf[2:4])[0] * 2 + 2
+            size = 2 + count * 2
+        if len(buf) < size:
+            return None
+        args = struct.unpack('>%dH' % count, buf[2:size])
+        if format in (self.STRING, self.BUTTON):
+            end = buf.find('\x00', size)
+            if end < 0:
+                return None
+            args = args + (buf[size:end],) if format == self.BUTTON else (buf[size:end],)
+            size = end + 1
+        return size, args
+
+    def word(self, value):
+        return struct.pack('>H', value & 0xffff)
+
+    def previous(self, opcode, value):
+        previous = self.state.get(opcode, 0)
+        self.state[opcode] = value
+        return self.word(previous)
+
+    def signed(self, *values):
+        """
+        Decode coordinates, which are sent in two's complement. Values
+        already decoded are returned unchanged.
+        """
+        return [value - 0x10000 if value >= 0x8000 else value for value in values]
+
+    def move_to(self, x, y):
+        self.origin = tuple(self.signed(x, y))
+        return ''
+
+    def bounds(self):
+        """
+        Return the drawable area: the screen, narrowed to the clip window
+        while clipping is enabled.
+        """
+        if not self.clipping:
+            return (0, 0, self.width - 1, self.height - 1)
+        x1, y1, x2, y2 = self.clip_window
+        return (max(x1, 0), max(y1, 0), min(x2, self.width - 1), min(y2, self.height - 1))
+
+    def pixel(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.page(self.read_page)[y * self.width + x]
+        return 0
+
+    def fill(self, x1, y1, x2, y2, colour):
+        bx1, by1, bx2, by2 = self.bounds()
+        x1, x2 = max(min(x1, x2), bx1), min(max(x1, x2), bx2)
+        y1, y2 = max(min(y1, y2), by1), min(max(y1, y2), by2)
+        if x1 > x2:
+            return
+        row = array.array('H', [colour]) * (x2 - x1 + 1)
+        for y in xrange(y1, y2 + 1):
+            self.page(self.write_page)[y * self.width + x1:y * self.width + x2 + 1] = row
+
+    def put_pixel(self, x, y, colour):
+        x, y = self.signed(x, y)
+        self.fill(x, y, x, y, colour)
+        return ''
+
+    def clear_screen(self):
+        clipping = self.clipping
+        self.clipping = False
+        self.fill(0, 0, self.width - 1, self.height - 1, self.state.get(Display.BACKGROUND_COLOUR, 0))
+        self.clipping = clipping
+        return ''
+
+    def line(self, x1, y1, x2, y2, colour):
+        x1, y1, x2, y2 = self.signed(x1, y1, x2, y2)
+        dx, dy = abs(x2 - x1), -abs(y2 - y1)
+        sx, sy = (1 if x1 < x2 else -1), (1 if y1 < y2 else -1)
+        error = dx + dy
+        while True:
+            self.put_pixel(x1, y1, colour)
+            if x1 == x2 and y1 == y2:
+                return ''
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x1 += sx
+            if doubled <= dx:
+                error += dx
+                y1 += sy
+
+    def line_to(self, x, y):
+        self.line(self.origin[0], self.origin[1], x, y, self.object_colour)
+        return self.move_to(x, y)
+
+    def polyline(self, n, *args):
+        xs, ys, colour = args[:n], args[n:2*n], args[-1]
+        for i in xrange(n - 1):
+            self.line(xs[i], ys[i], xs[i+1], ys[i+1], colour)
+        return ''
+
+    def polygon(self, n, *args):
+        self.polyline(n, *args)
+        if n > 1:
+            self.line(args[n-1], args[2*n-1], args[0], args[n], args[-1])
+        return ''
+
+    def rectangle(self, x1, y1, x2, y2, colour):
+        x1, y1, x2, y2 = self.signed(x1, y1, x2, y2)
+        self.fill(x1, y1, x2, y1, colour)
+        self.fill(x1, y2, x2, y2, colour)
+        self.fill(x1, y1, x1, y2, colour)
+        self.fill(x2, y1, x2, y2, colour)
+        return ''
+
+    def rectangle_filled(self, x1, y1, x2, y2, colour):
+        x1, y1, x2, y2 = self.signed(x1, y1, x2, y2)
+        self.fill(x1, y1, x2, y2, colour)
+        outline = self.state.get(Display.OUTLINE_COLOUR, 0)
+        if outline:
+            self.rectangle(x1, y1, x2, y2, outline)
+        return ''
+
+    def screen_copy_paste(self, xs, ys, xd, yd, width, height):
+        xs, ys, xd, yd = self.signed(xs, ys, xd, yd)
+        source = self.page(self.read_page)
+        rows = [(y, source[(ys + y) * self.width + xs:(ys + y) * self.width + xs + width])
+                for y in xrange(height) if 0 <= ys + y < self.height]
+        for y, row in rows:
+            for x, colour in enumerate(row):
+                self.fill(xd + x, yd + y, xd + x, yd + y, colour)
+        return ''
+
+    def set_clipping(self, enable):
+        self.clipping = bool(enable)
+        return ''
+
+    def set_clip_window(self, x1, y1, x2, y2):
+        self.clip_window = tuple(self.signed(x1, y1, x2, y2))
+        return ''
+
+    def page(self, index):
+        if index not in self.pages:
+            self.pages[index] = array.array('H', [0]) * (self.width * self.height)
+        return self.pages[index]
+
+    @property
+    def framebuffer(self):
+        return self.page(self.display_page)
+
+    def gfx_set(self, mode, value):
+        if mode == Display.GFX_SET_OBJECT_COLOUR:
+            self.object_colour = value
+        elif mode == Display.GFX_SET_PAGE_DISPLAY:
+            self.display_page = value
+        elif mode == Display.GFX_SET_PAGE_READ:
+            self.read_page = value
+        elif mode == Display.GFX_SET_PAGE_WRITE:
+            self.write_page = value
+        return ''
+
+    def orbit(self, angle, distance):
+        x = self.origin[0] + distance * math.cos(math.radians(angle))
+        y = self.origin[1] + distance * math.sin(math.radians(angle))
+        return struct.pack('>HH', int(round(x)) & 0xffff, int(round(y)) & 0xffff)
+
+    def slider(self, mode, x1, y1, x2, y2, colour, scale, value):
+        if x2 - x1 >= y2 - y1:
+            return self.word(x1 + (x2 - x1) * value / max(scale, 1))
+        return self.word(y2 - (y2 - y1) * value / max(scale, 1))
+
+    def gfx_get(self, mode):
+        if mode == Display.GFX_GET_X_MAX:
+            return self.word(self.width - 1)
+        if mode == Display.GFX_GET_Y_MAX:
+            return self.word(self.height - 1)
+        return self.word(0)
+
+    def touch(self, point, status=Display.TOUCH_STATUS_PRESS):
+        """
+        Simulate a touch at point. Touches outside the detect region are
+        not reported.
+        """
+        x1, y1, x2, y2 = self.touch_region
+        if not (x1 <= point[0] <= x2 and y1 <= point[1] <= y2):
+            status = Display.TOUCH_STATUS_NOTOUCH
+        self.touching = (status,) + tuple(point)
+
+    def detect_region(self, x1, y1, x2, y2):
+        self.touch_region = (x1, y1, x2, y2)
+        return ''
+
+    def touch_get(self, mode):
+        return self.word(self.touching[mode])
+
+    def set_baud_rate(self, index):
+        self.baudrate = dict(Display.BAUD_RATE_INDEX)[index]
+        return ''
@@ -0,0 +1,101 @@
+"""
+Soak benchmark of the ulcd43pct Display under simulated line faults.
+
+Runs a mixed workload against the simulator through
+transport.FaultyTransport, once for each fault profile, and reports the
+effective throughput, worst-case and 99th percentile call latency, and how
+often the display had to recover:
+
+    python soak.py [operations] [baudrate]
+"""
+
+import random
+import sys
+import time
+
+import simulator
+import transport
+import ulcd43pct as lcd
+
+PROFILES = [
+    ('clean', {}),
+    ('latency', dict(latency=0.002, jitter=0.004)),
+    ('drops', dict(latency=0.001, drop_rate=0.002)),
+    ('corruption', dict(latency=0.001, corrupt_rate=0.002)),
+    ('stalls', dict(latency=0.001, stall_rate=0.01, stall_time=0.1)),
+    ('everything', dict(latency=0.002, jitter=0.004, drop_rate=0.001,
+        corrupt_rate=0.001, stall_rate=0.005, stall_time=0.1)),
+]
+
+
+def operation(display, rng):
+    """
+    Perform one randomly chosen operation of the workload.
+    """
+    choice = rng.random()
+    point = (rng.randrange(480), rng.randrange(272))
+    colour = rng.randrange(0x10000)
+    if choice < 0.4:
+        display.gfx_RectangleFilled(point, (point[0] + 20, point[1] + 10), colour)
+    elif choice < 0.6:
+        display.txt_FGcolour(colour)
+    elif choice < 0.7:
+        display.gfx_Orbit(rng.randrange(360), 50)
+    elif choice < 0.8:
+        display.sys_GetModel()
+    else:
+        with display.batch():
+            for i in xrange(8):
+                display.gfx_PutPixel((point[0] + i, point[1]), colour)
+
+
+def soak(faults, operations=500, baudrate=115200, seed=0):
+    """
+    Run operations random operations over a line with faults, which are
+    keyword arguments of FaultyTransport. Returns a dictionary of results.
+    """
+    device = simulator.Device()
+    device.baudrate = baudrate
+    line = transport.FaultyTransport(device, seed=seed, **faults)
+    display = lcd.Display(serial_baudrate=baudrate, transport=line)
+    display.connect()
+    rng = random.Random(seed)
+    latencies = []
+    failures = 0
+    start = time.time()
+    for i in xrange(operations):
+        begin = time.time()
+        try:
+            operation(display, rng)
+        except Exception:
+            failures += 1
+        latencies.append(time.time() - begin)
+    elapsed = time.time() - start
+    display.close()
+    latencies.sort()
+    results = {
+        'operations': operations,
+        'elapsed': elapsed,
+        'throughput': display.counters['command_bytes'] / elapsed,
+        'worst': latencies[-1],
+        'p99': latencies[int(len(latencies) * 0.99)],
+        'failures': failures,
+    }
+    for key in ('resyncs', 'retries', 'timeouts'):
+        results[key] = display.counters[key]
+    results.update(line.counters)
+    return results
+
+
+def main(argv):
+    operations = int(argv[1]) if len(argv) > 1 else 500
+    baudrate = int(argv[2]) if len(argv) > 2 else 115200
+    print '%-12s %10s %9s %9s %8s %8s %8s' % ('profile', 'bytes/s', 'worst ms', 'p99 ms', 'failures', 'resyncs', 'retries')
+    for name, faults in PROFILES:
+        r = soak(faults, operations, baudrate)
+        print '%-12s %10.0f %9.1f %9.1f %8d %8d %8d' % (name, r['throughput'], r['worst'] * 1000,
+                r['p99'] * 1000, r['failures'], r['resyncs'], r['retries'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
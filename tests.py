@@ -1,8 +1,28 @@
+import math
 import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
 import time
 import unittest
 
+import atlas
+import bridge
+import manager
+import path
+import peephole
+import simulator
+import soak
+import transport
 import ulcd43pct as lcd
+import widgets
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class DisplayTestCase(unittest.TestCase):
 
@@ -390,5 +410,742 @@ class GfxTestCase(DisplayTestCase):
 
 
 
+class LoopbackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = simulator.Device()
+        self.display = lcd.Display(transport=transport.LoopbackTransport(self.device))
+        self.display.connect()
+
+    def tearDown(self):
+        self.display.close()
+
+    def testGetModel(self):
+        self.assertEqual('uLCD-43', self.display.sys_GetModel()[:7])
+
+    def testDetectDimensions(self):
+        self.assertEquals((480, 272), self.display.detect_dimensions())
+
+    def testReplyWords(self):
+        self.assertEquals(0, self.display.txt_FGcolour(GfxTestCase.RED))
+        self.assertEquals(GfxTestCase.RED, self.display.txt_FGcolour(GfxTestCase.GREEN))
+        self.display.gfx_MoveTo((0, 0))
+        self.assertEquals(self.display.gfx_Orbit(40, 60), (46, 39))
+
+    def testPackWords(self):
+        self.assertEqual('\xff\xfb\x80\x00\xff\xff', self.display.pack_words((-5, -0x8000, 0xffff)))
+        self.assertRaises(struct.error, self.display.pack_words, (0x10000,))
+        self.assertRaises(struct.error, self.display.pack_words, (-0x8001,))
+
+    def testResync(self):
+        self.display.ser.rbuf += '\x99\x00'
+        self.assertEquals(479, self.display.gfx_Get(self.display.GFX_GET_X_MAX))
+        self.assertEquals(1, self.display.counters['resyncs'])
+        self.assertEquals(1, self.display.counters['retries'])
+        # Setters returning the previous value are not retried, since a
+        # retry of one that ran would return the new value
+        self.assertEquals(0, self.display.txt_BGcolour(GfxTestCase.RED))
+        self.display.ser.rbuf += '\x99\x00'
+        self.assertRaises(lcd.ProtocolError, self.display.txt_BGcolour, GfxTestCase.GREEN)
+        self.assertEquals(1, self.display.counters['retries'])
+        self.assertEquals(GfxTestCase.GREEN, self.display.txt_BGcolour(GfxTestCase.BLUE))
+
+    def testBatch(self):
+        with self.display.batch():
+            for i in xrange(100):
+                self.assertTrue(self.display.gfx_RectangleFilled((0, 0), (i, i), GfxTestCase.RED))
+        self.assertEquals(100, self.device.counters['commands'])
+        self.assertTrue(self.display.counters['writes'] < 10)
+
+    def testReplyReader(self):
+        reads = self.display.counters['reads']
+        self.assertEqual('uLCD-43PT', self.display.sys_GetModel())
+        self.assertEqual(1, self.display.counters['reads'] - reads)
+        reads = self.display.counters['reads']
+        writes = self.display.counters['writes']
+        with self.display.batch():
+            # gfx_Slider replies with a WORD even where only an ACK is expected
+            slider = self.display.pack_words((0, 0, 0, 99, 9, 0, 100, 50))
+            self.assertTrue(self.display.transact(self.display.SLIDER + slider))
+            for i in xrange(100):
+                self.display.gfx_RectangleFilled((0, 0), (i, i), GfxTestCase.RED)
+        self.assertEqual(self.display.counters['writes'] - writes, self.display.counters['reads'] - reads)
+        self.display.gfx_MoveTo((0, 0))
+        self.assertEquals((10, 0), self.display.gfx_Orbit(0, 10))
+        self.assertEquals(0, self.display.counters['resyncs'])
+
+    def testPath(self):
+        circle = path.Path().arc((100, 100), 50, 0, 360)
+        points = circle.flatten(tolerance=0.5)[0]
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            self.assertTrue(math.hypot((x1 + x2) / 2 - 100, (y1 + y2) / 2 - 100) >= 50 - 0.5)
+        shape = path.Path().move_to((10, 10)).curve_to((60, 0), (100, 80), (150, 40)).line_to((150, 100)).close()
+        shape.move_to((20, 50)).quad_to((40, 100), (60, 50))
+        self.assertTrue(shape.compile() is shape.compile())
+        self.assertFalse(shape.compile() is shape.compile(transform=(2, 0, 0, 2, 0, 0)))
+        commands = shape.draw(self.display, GfxTestCase.RED)
+        self.assertEqual(['gfx_Polyline'] * 2, [name for name, args in commands])
+        device = simulator.Device()
+        display = lcd.Display(transport=transport.LoopbackTransport(device))
+        display.connect()
+        for vertices in shape.compile():
+            for start, end in zip(vertices, vertices[1:]):
+                display.gfx_Line(start, end, GfxTestCase.RED)
+        self.assertEqual(device.framebuffer, self.device.framebuffer)
+        self.assertTrue(self.display.counters['command_bytes'] < display.counters['command_bytes'] / 2)
+
+    def testAtlas(self):
+        self.display.detect_dimensions()
+        icons = atlas.Atlas(self.display)
+        rendered = []
+        def render(display, (x, y)):
+            rendered.append((x, y))
+            display.gfx_RectangleFilled((x, y), (x + 9, y + 9), GfxTestCase.RED)
+            display.gfx_Line((x, y), (x + 9, y + 9), GfxTestCase.GREEN)
+        with icons.stamping():
+            for i in xrange(10):
+                icons.stamp('icon', (10, 10), render, (i * 20, 100))
+        self.assertEqual(1, len(rendered))
+        self.assertEqual(9, icons.counters['hits'])
+        for i in xrange(10):
+            self.assertEqual(GfxTestCase.GREEN, self.device.framebuffer[100 * 480 + i * 20])
+            self.assertEqual(GfxTestCase.RED, self.device.framebuffer[100 * 480 + i * 20 + 1])
+        self.assertEqual(0, self.device.framebuffer[0])
+        self.assertEqual((0, 0), (self.device.read_page, self.device.write_page))
+        # Least recently stamped assets are evicted first
+        icons = atlas.Atlas(self.display, size=(40, 20))
+        for key in ('a', 'b', 'a', 'c'):
+            icons.stamp(key, (20, 20), render, (0, 0))
+        self.assertEqual(['a', 'c'], list(icons.entries))
+        self.assertEqual(1, icons.counters['evictions'])
+        # Space freed on the left of a shelf is reused
+        icons = atlas.Atlas(self.display, size=(60, 20))
+        for key in ('a', 'b', 'c', 'b', 'c', 'd'):
+            icons.stamp(key, (20, 20), render, (0, 0))
+        self.assertEqual(['b', 'c', 'd'], list(icons.entries))
+        self.assertEqual(1, icons.counters['evictions'])
+        self.assertEqual((0, 0, 20, 20), icons.entries['d'])
+        # Stamps are clipped to the clip window of the caller
+        icons = atlas.Atlas(self.display)
+        self.display.set_clip((100, 150, 109, 159))
+        icons.stamp('icon', (10, 10), render, (105, 150))
+        self.assertEqual(GfxTestCase.RED, self.device.framebuffer[151 * 480 + 109])
+        self.assertEqual(0, self.device.framebuffer[151 * 480 + 110])
+        self.assertEqual((True, (100, 150, 109, 159)), (self.display.clipping, self.display.clip_window))
+
+    def testPeephole(self):
+        rng = random.Random(4)
+        point = lambda: (rng.randrange(64), rng.randrange(48))
+        colour = lambda: rng.choice((0, GfxTestCase.RED, GfxTestCase.GREEN))
+        generators = [
+            lambda: ('gfx_RectangleFilled', (point(), point(), colour())),
+            lambda: ('gfx_Rectangle', (point(), point(), colour())),
+            lambda: ('gfx_Line', (point(), point(), colour())),
+            lambda: ('gfx_PutPixel', (point(), colour())),
+            lambda: ('gfx_MoveTo', (point(),)),
+            lambda: ('gfx_LineTo', (point(),)),
+            lambda: ('gfx_Set', (lcd.Display.GFX_SET_OBJECT_COLOUR, colour())),
+            lambda: ('gfx_OutlineColour', (colour(),)),
+            lambda: ('gfx_BackgroundColour', (colour(),)),
+            lambda: ('gfx_Clipping', (rng.random() < 0.5,)),
+            lambda: ('gfx_ClipWindow', (point(), point())),
+            lambda: ('gfx_ScreenCopyPaste', (point(), point(), 8, 8)),
+            lambda: ('gfx_Cls', ()),
+        ]
+        saved = 0
+        for i in xrange(20):
+            commands = [rng.choice(generators[:7] if i % 2 else generators)() for j in xrange(60)]
+            optimized, report = peephole.optimize(commands)
+            framebuffers = []
+            for display_list in (commands, optimized):
+                device = simulator.Device(64, 48)
+                display = lcd.Display(transport=transport.LoopbackTransport(device))
+                display.connect()
+                manager.DisplayList(display_list).replay(display)
+                framebuffers.append(device.framebuffer)
+            self.assertEqual(framebuffers[0], framebuffers[1])
+            self.assertEqual(report['before'] - report['after'], report['saved'])
+            saved += report['saved']
+        self.assertTrue(saved > 0)
+        # State reset as a side effect of other commands is set again
+        window = ('gfx_ClipWindow', ((0, 0), (9, 9)))
+        outline = ('gfx_OutlineColour', (GfxTestCase.RED,))
+        bold = ('txt_Bold', (True,))
+        for commands in ([window, ('gfx_SetClipRegion', ()), window],
+                [outline, ('gfx_Cls', ()), outline],
+                [bold, ('txt_Attributes', (0,)), bold],
+                [outline, ('gfx_ChangeColour', (0, GfxTestCase.RED)), outline]):
+            self.assertEqual(commands, peephole.optimize(commands)[0])
+        commands = [outline, ('gfx_ScreenCopyPaste', ((0, 0), (9, 9), 8, 8)), outline]
+        self.assertEqual(commands[:2], peephole.optimize(commands)[0])
+
+
+class HungTransport(transport.LoopbackTransport):
+    """
+    Loopback transport to a device that can stop replying. Reads that come
+    up short advance a fake clock by their timeout instead of blocking.
+    """
+
+    def __init__(self, device):
+        super(HungTransport, self).__init__(device)
+        self.hung = False
+        self.clock = 0.0
+        self.waits = []
+
+    def write(self, buf):
+        if self.hung:
+            return len(buf)
+        return super(HungTransport, self).write(buf)
+
+    def read(self, size):
+        buf = super(HungTransport, self).read(size)
+        if len(buf) < size:
+            self.clock += self.timeout
+            self.waits.append(self.timeout)
+        return buf
+
+
+class LatencyModelTestCase(unittest.TestCase):
+
+    OPCODE = lcd.Display.MOVE_TO
+
+    def testDeadline(self):
+        model = lcd.LatencyModel()
+        small = model.deadline(self.OPCODE, 10, 9600)
+        large = model.deadline(self.OPCODE, 1010, 9600)
+        self.assertAlmostEqual(1000 * 10 / 9600.0, large - small, delta=model.GRANULARITY)
+        self.assertTrue(model.deadline(self.OPCODE, 1010, 115200) < large / 5)
+        self.assertEqual(small + 1, model.deadline(self.OPCODE, 10, 9600, delay=1))
+        self.assertEqual(model.MAX_DEADLINE, model.deadline(self.OPCODE, 10 ** 6, 9600))
+
+    def testUpdate(self):
+        model = lcd.LatencyModel({self.OPCODE: 0.5})
+        rng = random.Random(5)
+        for i in xrange(100):
+            elapsed = model.wire_time(7, 9600) + rng.uniform(0.004, 0.006)
+            model.update(self.OPCODE, 7, 9600, elapsed)
+        mean, deviation = model.estimate(self.OPCODE)
+        self.assertAlmostEqual(0.005, mean, delta=0.001)
+        self.assertTrue(deviation < 0.002)
+        self.assertEqual(model.MIN_DEADLINE, model.deadline(self.OPCODE, 7, 9600))
+
+    def testHang(self):
+        line = HungTransport(simulator.Device())
+        display = lcd.Display(transport=line)
+        display.connect()
+        for i in xrange(20):
+            display.gfx_MoveTo((i, i))
+        line.hung = True
+        line.waits = []
+        self.assertRaises(lcd.ReplyTimeout, display.gfx_MoveTo, (0, 0))
+        # The hang is noticed after the modelled deadline rather than
+        # TIMEOUT. The rest of the waits are for the resync marker.
+        self.assertEqual(display.latency.MIN_DEADLINE, line.waits[0])
+        attempts = [wait for wait in line.waits if wait < display.RESYNC_WAIT / 2]
+        self.assertEqual(display.RETRY_LIMIT + 1, len(attempts))
+        self.assertTrue(sum(attempts) < 0.1)
+        self.assertEqual(display.RETRY_LIMIT + 1, display.counters['timeouts'])
+
+    def testRetryBackoff(self):
+        line = HungTransport(simulator.Device())
+        display = lcd.Display(transport=line)
+        display.connect()
+        display.latency.estimates[display.MOVE_TO] = [0.03, 0.0]
+        line.hung = True
+        line.waits = []
+        self.assertRaises(lcd.ReplyTimeout, display.gfx_MoveTo, (0, 0))
+        # Each retry waits for the backed off estimate
+        attempts = [wait for wait in line.waits if wait < display.RESYNC_WAIT / 2]
+        self.assertEqual(display.RETRY_LIMIT + 1, len(attempts))
+        self.assertEqual(sorted(set(attempts)), attempts)
+
+    def testCorruption(self):
+        device = simulator.Device()
+        display = lcd.Display(transport=transport.LoopbackTransport(device))
+        display.connect()
+        # Garbage arriving on time is no reason to wait longer
+        display.ser.rbuf += '\x99\x00'
+        display.gfx_MoveTo((10, 10))
+        self.assertEqual(1, display.counters['retries'])
+        self.assertEqual(0, display.counters['timeouts'])
+        self.assertTrue(display.latency.estimate(self.OPCODE)[0] < display.latency.DEFAULT_EXECUTION)
+        display.close()
+
+
+class FaultyLineTestCase(unittest.TestCase):
+
+    def testSoak(self):
+        for name, faults in soak.PROFILES:
+            results = soak.soak(faults, operations=100)
+            self.assertTrue(results['throughput'] > 0)
+            if name == 'clean':
+                self.assertEqual(0, results['failures'] + results['resyncs'])
+        self.assertTrue(results['resyncs'] > 0)
+
+    def testRecovery(self):
+        device = simulator.Device()
+        line = transport.FaultyTransport(device, drop_rate=0.01, corrupt_rate=0.01, seed=1)
+        display = lcd.Display(transport=line)
+        display.connect()
+        for i in xrange(50):
+            try:
+                display.gfx_Orbit(0, 10)
+            except Exception:
+                pass
+        line.drop_rate = line.corrupt_rate = 0
+        display.gfx_MoveTo((0, 0))
+        self.assertEqual((10, 0), display.gfx_Orbit(0, 10))
+        self.assertTrue(display.counters['resyncs'] > 0)
+        display.close()
+
+    def testLateReply(self):
+        device = simulator.Device()
+        line = transport.FaultyTransport(device, stall_rate=1, stall_time=0.1, seed=3)
+        display = lcd.Display(transport=line)
+        display.connect()
+        try:
+            display.txt_FGcolour(GfxTestCase.RED)
+        except lcd.ProtocolError:
+            pass
+        self.assertTrue(display.counters['resyncs'] > 0)
+        # Replies arriving after the deadline are not taken for later ones
+        line.stall_rate = 0
+        self.assertEqual(GfxTestCase.RED, display.txt_FGcolour(GfxTestCase.GREEN))
+        self.assertEqual(GfxTestCase.GREEN, display.txt_FGcolour(GfxTestCase.BLUE))
+        display.close()
+
+    def testReplyReads(self):
+        display = lcd.Display(transport=transport.FaultyTransport(simulator.Device(), latency=0.003))
+        display.connect()
+        reads = display.counters['reads']
+        self.assertEqual(0, display.txt_FGcolour(GfxTestCase.RED))
+        self.assertEqual(1, display.counters['reads'] - reads)
+        # A string reply needs its length before the rest can be read
+        reads = display.counters['reads']
+        self.assertEqual('uLCD-43PT', display.sys_GetModel())
+        self.assertEqual(2, display.counters['reads'] - reads)
+        # Flushing with nothing pending leaves the timeout alone
+        display.flush()
+        self.assertTrue(display.setbaudWait(19200))
+        self.assertEqual('uLCD-43PT', display.sys_GetModel())
+        self.assertEqual(0, display.counters['resyncs'])
+        display.close()
+
+    def testDetectBaudrate(self):
+        device = simulator.Device()
+        device.baudrate = 19200
+        display = lcd.Display(transport=transport.FaultyTransport(device, seed=2))
+        display.connect()
+        self.assertEqual(19200, display.detect_serial_baudrate())
+        self.assertEqual('uLCD-43PT', display.sys_GetModel())
+        display.close()
+
+
+class ManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = [simulator.Device() for i in xrange(3)]
+        displays = [lcd.Display(transport=transport.LoopbackTransport(device)) for device in self.devices]
+        self.manager = manager.DisplayManager(displays)
+        self.manager.connect()
+
+    def tearDown(self):
+        self.manager.close()
+
+    def testBroadcast(self):
+        self.assertEqual(['display0', 'display1', 'display2'], self.manager.names)
+        dl = manager.DisplayList()
+        for i in xrange(50):
+            dl.gfx_RectangleFilled((i, i), (i + 10, i + 10), GfxTestCase.RED)
+        dl.txt_FGcolour(GfxTestCase.GREEN)
+        results = self.manager.wait(self.manager.broadcast(dl))
+        self.assertEqual([[True] * 50 + [0]] * 3, results)
+        for name, device in zip(self.manager.names, self.devices):
+            self.assertEqual(self.devices[0].framebuffer, device.framebuffer)
+            # Replay is pipelined rather than waiting for each ACK
+            self.assertTrue(self.manager.display(name).counters['writes'] < 10)
+        jobs = [self.manager.call(name, 'txt_FGcolour', 0) for name in self.manager.names]
+        self.assertEqual([GfxTestCase.GREEN] * 3, self.manager.wait(jobs))
+        self.assertRaises(Exception, self.manager.add, self.manager.display('display0'), 'display0')
+
+
+class BridgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = simulator.Device()
+        self.display = lcd.Display(transport=transport.LoopbackTransport(self.device))
+        self.display.connect()
+        self.directory = tempfile.mkdtemp()
+        self.server = bridge.BridgeServer(self.display, os.path.join(self.directory, 'display'))
+        self.server.start()
+        self.clients = [bridge.BridgeDisplay(self.server.address) for i in xrange(3)]
+        for client in self.clients:
+            client.connect()
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.display.close()
+        shutil.rmtree(self.directory)
+
+    def testReplies(self):
+        for client in self.clients:
+            self.assertEqual('uLCD-43', client.sys_GetModel()[:7])
+            self.assertEqual(0, client.gfx_Get(client.GFX_GET_OBJECT_LEFT))
+
+    def testDelay(self):
+        delays = []
+        transact = self.display.transact
+        def record(buf, reply, delay=0):
+            delays.append(delay)
+            return transact(buf, reply, delay=delay)
+        self.display.transact = record
+        self.assertEqual(0, self.clients[0].sys_Sleep(2))
+        self.assertEqual([2], delays)
+
+    def testBatch(self):
+        for client in self.clients:
+            with client.batch():
+                for i in xrange(50):
+                    self.assertTrue(client.gfx_RectangleFilled((0, 0), (i, i), GfxTestCase.RED))
+        self.assertEqual(150, self.device.counters['commands'])
+
+    def testFrameIsolation(self):
+        self.display.detect_dimensions()
+        def frame(draw):
+            client = bridge.BridgeDisplay(None)
+            with client.batch():
+                draw(client)
+                queued, client.queued = client.queued, []
+            return bridge.Frame(queued)
+        def clipped(client):
+            client.gfx_ClipWindow((0, 0), (9, 9))
+            client.gfx_Clipping(True)
+            for x in xrange(40):
+                client.gfx_PutPixel((x, 0), GfxTestCase.RED)
+            client.gfx_Clipping(False)
+        def unclipped(client):
+            for x in xrange(100, 140):
+                client.gfx_PutPixel((x, 100), GfxTestCase.GREEN)
+        # A server whose rounds are run by hand, with both frames queued
+        server = bridge.BridgeServer(self.display, None)
+        server.running = True
+        server.sessions = [bridge.Session(server, None) for i in xrange(2)]
+        server.sessions[0].frames.append(frame(clipped))
+        server.sessions[1].frames.append(frame(unclipped))
+        while any(session.frames for session in server.sessions):
+            server.execute_round(server.schedule())
+        framebuffer = self.device.framebuffer
+        self.assertEqual([GfxTestCase.RED] * 10 + [0] * 30, list(framebuffer[:40]))
+        self.assertEqual([GfxTestCase.GREEN] * 40, list(framebuffer[100 * 480 + 100:100 * 480 + 140]))
+
+    def testErrorAttribution(self):
+        client = bridge.BridgeDisplay(None)
+        with client.batch():
+            for i in xrange(60):
+                client.gfx_Rectangle((0, 0), (i, i), GfxTestCase.RED)
+            rectangles, client.queued = client.queued, []
+        frames = [bridge.Frame([(lcd.Display.REPLY_ACK, 0, '\xee\x00')]), bridge.Frame(rectangles)]
+        server = bridge.BridgeServer(self.display, None)
+        server.running = True
+        server.sessions = [bridge.Session(server, None) for frame in frames]
+        for session, frame in zip(server.sessions, frames):
+            session.frames.append(frame)
+        server.execute_round(server.schedule())
+        self.assertEqual([(bridge.STATUS_ERR, '')], frames[0].results)
+        self.assertEqual([(bridge.STATUS_OK, '')] * 60, frames[1].results)
+
+    def testSlowClient(self):
+        # A client that sends commands but never reads the replies
+        sock = bridge.create_socket(self.server.address)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(self.server.address)
+        while len(self.server.sessions) < 4:
+            time.sleep(0.01)
+        self.server.sessions[-1].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        for i in xrange(2000):
+            bridge.write_frame(sock, [(lcd.Display.REPLY_STRING, 0, lcd.Display.GET_DISPLAY_MODEL)], bridge.REQUEST_HEADER)
+        client = self.clients[0]
+        client.sock.settimeout(5)
+        self.assertEqual('uLCD-43', client.sys_GetModel()[:7])
+        sock.close()
+
+
+class WidgetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = simulator.Device()
+        self.display = lcd.Display(transport=transport.LoopbackTransport(self.device))
+        self.display.connect()
+        self.display.detect_dimensions()
+        self.canvas = widgets.Canvas(self.display)
+
+    def tearDown(self):
+        self.display.close()
+
+    def testLargeGrid(self):
+        grid = widgets.MatrixGrid()
+        self.canvas.add_child(grid)
+        cells = [widgets.Widget() for i in xrange(10000)]
+        for cell in cells:
+            grid.add_child(cell)
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual((0, 0, 5, 3), cells[0].envelope)
+        # The grid overflows the screen; cells beyond it are not drawn.
+        visible = [cell for cell in cells if cell.envelope[0] < 480 and cell.envelope[1] < 272]
+        self.assertTrue(len(visible) < len(cells))
+        self.assertFalse(any(cell.dirty for cell in visible))
+        self.assertTrue(all(cell.children_fits for cell in visible))
+        self.assertTrue(cells[-1].dirty)
+
+    def testViewportCulling(self):
+        window = widgets.Widget(envelope=(0, 0, 239, 99))
+        self.canvas.add_child(window)
+        window.envelope = (0, 0, 239, 99)
+        grid = widgets.XGrid()
+        window.add_child(grid)
+        panes = [widgets.ProgressBar(value=100) for i in xrange(3)]
+        for pane in panes:
+            grid.add_child(pane)
+        self.canvas.draw_dirty(self.display)
+        self.display.gfx_Clipping(False)
+        grid.set_envelope((-300, 0, 659, 99))
+        commands = self.device.counters['commands']
+        self.canvas.draw_dirty(self.display)
+        # One clip window serves the grid and both visible panes, and the
+        # right pane is outside the window. Clipping is turned off again
+        # at the end.
+        self.assertEqual(False, self.display.clipping)
+        self.assertTrue(panes[2].dirty)
+        self.assertEqual(2 + 2 + 1, self.device.counters['commands'] - commands)
+        self.assertNotEqual(0, self.device.framebuffer[239])
+        self.assertEqual(0, self.device.framebuffer[240])
+        self.display.gfx_RectangleFilled((300, 150), (310, 160), GfxTestCase.RED)
+        self.assertEqual(GfxTestCase.RED, self.device.framebuffer[150 * 480 + 300])
+        commands = self.device.counters['commands']
+        panes[1].set_value(0)
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(2 + 1 + 1, self.device.counters['commands'] - commands)
+        self.assertEqual(False, self.display.clipping)
+
+    def testAddChild(self):
+        self.canvas.orientation = widgets.Widget.ORIENTATION_MATRIX
+        bars = [widgets.ProgressBar(value=100) for i in xrange(6)]
+        for bar in bars[:5]:
+            self.canvas.add_child(bar)
+        self.canvas.draw_dirty(self.display)
+        envelopes = [bar.envelope for bar in bars[:5]]
+        # The canvas clears the screen, so siblings that did not move are
+        # drawn again
+        self.canvas.add_child(bars[5])
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(envelopes, [bar.envelope for bar in bars[:5]])
+        for bar in bars:
+            x1, y1, x2, y2 = bar.envelope
+            self.assertEqual(bar.foreground, self.device.framebuffer[y1 * 480 + x1])
+
+    def testUnknownClipRegion(self):
+        bar = widgets.ProgressBar(value=50)
+        self.canvas.add_child(bar)
+        self.canvas.draw_dirty(self.display)
+        bar.set_envelope((-100, 0, 99, 99))
+        self.display.gfx_ClipWindow((0, 0), (49, 49))
+        self.display.gfx_SetClipRegion()
+        self.display.gfx_Clipping(True)
+        self.canvas.draw_dirty(self.display)
+        # The clip region of the caller is kept
+        self.assertEqual((True, None), (self.display.clipping, self.display.clip_window))
+        self.assertEqual(True, self.device.clipping)
+
+    def testProfiler(self):
+        grid = widgets.XGrid()
+        self.canvas.add_child(grid)
+        buttons = [widgets.Button(text='Button %d' % i) for i in xrange(3)]
+        for button in buttons:
+            grid.add_child(button)
+        commands = self.display.counters['commands']
+        with widgets.Profiler() as profiler:
+            self.canvas.draw_dirty(self.display)
+        self.assertTrue(widgets.PROFILER is None)
+        totals = profiler.totals(self.canvas)
+        self.assertEqual(self.display.counters['commands'] - commands, totals[self.canvas.id][0])
+        self.assertEqual(sum(totals[button.id][0] for button in buttons), totals[grid.id][0])
+        report = profiler.report(self.canvas, 'commands').splitlines()
+        self.assertEqual(2 + len(buttons) + 1, len(report))
+        self.assertTrue(report[1].startswith('Canvas#'))
+        for line in profiler.folded(self.canvas, 'bytes').splitlines():
+            path, value = line.rsplit(' ', 1)
+            self.assertTrue(path.startswith(profiler.name(self.canvas) + ';'))
+            self.assertTrue(int(value) > 0)
+
+    def testTouchEvents(self):
+        grid = widgets.XGrid()
+        self.canvas.add_child(grid)
+        panel = widgets.Widget()
+        slider = widgets.Slider()
+        grid.add_child(panel)
+        grid.add_child(slider)
+        events = widgets.TouchEvents(self.canvas)
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(None, events.poll(0))
+        self.assertEqual(widgets.intersection(slider.envelope, (0, 0, 479, 271)), self.device.touch_region)
+        # Touches outside the region are filtered by the display
+        self.device.touch((10, 10))
+        self.assertEqual(None, events.poll(1))
+        x1, y1, x2, y2 = slider.envelope
+        self.device.touch(((x1 + x2) / 2, (y1 + y2) / 2))
+        commands = self.display.counters['commands']
+        status, point, widget = events.poll(2)
+        self.assertEqual(3, self.display.counters['commands'] - commands)
+        self.assertTrue(widget is slider)
+        self.assertEqual(50, slider.value)
+        # The region is only reprogrammed after the layout changes
+        touched = []
+        panel.on_touch = lambda *args: touched.append(args)
+        events.invalidate()
+        events.poll(3)
+        self.assertEqual(grid.envelope[:2], self.device.touch_region[:2])
+        self.device.touch((10, 10))
+        self.assertTrue(events.poll(4)[2] is panel)
+        self.assertEqual(1, len(touched))
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def testChart(self):
+        # Laying out and drawing an empty chart does not need NumPy
+        widgets.numpy = None
+        chart = widgets.Chart()
+        self.canvas.add_child(chart)
+        self.canvas.draw_dirty(self.display)
+        self.assertTrue(widgets.numpy is None)
+        chart.push([0.5])
+        self.assertTrue(widgets.numpy is numpy)
+        samples = numpy.sin(numpy.arange(100050) / 500.0)
+        framebuffers = []
+        updates = []
+        for blocks in ((samples[:100000], samples[100000:]), (samples,)):
+            device = simulator.Device()
+            display = lcd.Display(transport=transport.LoopbackTransport(device))
+            display.connect()
+            display.detect_dimensions()
+            canvas = widgets.Canvas(display)
+            window = widgets.Widget()
+            canvas.add_child(window)
+            window.envelope = (0, 0, 239, 99)
+            chart = widgets.Chart(samples_per_column=10, minimum=-1, maximum=1)
+            window.add_child(chart)
+            for block in blocks:
+                chart.push(block)
+                commands = device.counters['commands']
+                canvas.draw_dirty(display)
+                updates.append(device.counters['commands'] - commands)
+            self.assertEqual(240, len(chart.mins))
+            self.assertTrue(len(chart.carry) < 10)
+            framebuffers.append(device.framebuffer)
+        # Scrolling by 5 columns: copy, clear the new strip, and 5 lines
+        self.assertEqual(1 + 1 + 5, updates[1])
+        self.assertEqual(framebuffers[0], framebuffers[1])
+
+    def testDeepTree(self):
+        widget = self.canvas
+        for i in xrange(5000):
+            child = widgets.Widget()
+            widget.add_child(child)
+            widget = child
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(self.canvas.envelope, widget.envelope)
+        self.assertFalse(widget.dirty)
+
+    def testReconcile(self):
+        def render(items, progress):
+            return [widgets.Element(widgets.YGrid, children=
+                [widgets.Element(widgets.Button, key=name, text=text) for name, text in items]
+                + [widgets.Element(widgets.ProgressBar, key='progress', value=progress)])]
+        items = [('a', 'Alpha'), ('b', 'Beta'), ('c', 'Gamma')]
+        widgets.reconcile(self.canvas, render(items, 10))
+        self.canvas.draw_dirty(self.display)
+        grid = self.canvas.children[0]
+        a, b, c, bar = grid.children
+        self.assertEqual('Beta', b.text)
+        # Nothing changed: nothing is marked, nothing is sent
+        commands = self.display.counters['commands']
+        widgets.reconcile(self.canvas, render(items, 10))
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(commands, self.display.counters['commands'])
+        # A changed property marks only its widget
+        widgets.reconcile(self.canvas, render([('a', 'Alpha'), ('b', 'Bravo'), ('c', 'Gamma')], 20))
+        self.assertEqual([a, b, c, bar], grid.children)
+        self.assertEqual('Bravo', b.text)
+        self.assertEqual([False, True, False, False], [widget.dirty for widget in grid.children])
+        self.assertTrue(widgets.STORE.flags[bar.id] & widgets.WidgetStore.UPDATED)
+        self.assertFalse(grid.dirty)
+        self.canvas.draw_dirty(self.display)
+        # Removing and reordering keyed children reuses the instances
+        widgets.reconcile(self.canvas, render([('c', 'Gamma'), ('a', 'Alpha')], 20))
+        self.assertEqual([c, a, bar], grid.children)
+        self.assertTrue(grid.dirty)
+        self.assertEqual(None, b.parent)
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(grid.envelope[:2], c.envelope[:2])
+        # A widget of another class under the same key replaces the old one
+        widgets.reconcile(grid, [widgets.Element(widgets.Widget, key='c')])
+        self.assertEqual(None, c.parent)
+        self.assertTrue(grid.children[0].parent is grid)
+
+    def testFrameScheduler(self):
+        button = widgets.Button(text='Hello')
+        self.canvas.add_child(button)
+        scheduler = widgets.FrameScheduler(self.canvas, max_fps=10)
+        now = time.time()
+        for i in xrange(10):
+            scheduler.invalidate(button)
+            scheduler.poll(now)
+        self.assertEqual(1, scheduler.frames)
+        self.assertEqual(8, scheduler.coalesced)
+        scheduler.invalidate(button)
+        self.assertFalse(scheduler.poll(now))
+        self.assertTrue(scheduler.poll(now + scheduler.interval()))
+        self.assertFalse(button.dirty)
+
+    def testValueWidgets(self):
+        grid = widgets.YGrid()
+        self.canvas.add_child(grid)
+        for widget in (widgets.ProgressBar(), widgets.Slider(), widgets.Gauge()):
+            grid.add_child(widget)
+        self.canvas.draw_dirty(self.display)
+        for value in (10, 50, 30, 100, 0):
+            for widget in grid.children:
+                widget.set_value(value)
+            written = self.display.counters['bytes_written']
+            self.canvas.draw_dirty(self.display)
+            for widget in grid.children:
+                self.assertEqual(value, widget.drawn_value)
+            self.assertTrue(self.display.counters['bytes_written'] - written <= 3 * 24)
+        # The slider thumb moves by erasing and drawing the strips it left
+        # and entered
+        slider = grid.children[1]
+        slider.set_value(1)
+        self.canvas.draw_dirty(self.display)
+        x1, y1, x2, y2 = slider.envelope
+        start = slider.thumb(1)
+        self.assertEqual(slider.background, self.device.framebuffer[y1 * 480 + x1])
+        self.assertEqual(slider.foreground, self.device.framebuffer[y1 * 480 + x1 + start])
+        self.assertEqual(slider.foreground, self.device.framebuffer[y1 * 480 + x1 + start + slider.THUMB_SIZE - 1])
+        self.assertEqual(slider.background, self.device.framebuffer[y1 * 480 + x1 + start + slider.THUMB_SIZE])
+
+    def testLogView(self):
+        log = widgets.LogView(lines=['line %d' % i for i in xrange(100000)])
+        self.canvas.add_child(log)
+        self.canvas.draw_dirty(self.display)
+        self.assertEqual(len(log.lines) - log.rows(), log.offset)
+        commands = self.device.counters['commands']
+        log.append('last line')
+        self.canvas.draw_dirty(self.display)
+        # One copy, then clear, move and print a single row
+        self.assertEqual(4, self.device.counters['commands'] - commands)
+        self.assertEqual(len(log.lines) - log.rows(), log.drawn_offset)
+
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,331 @@
+"""
+Byte transports for the ulcd43pct Display class.
+
+A transport carries the PICASO serial protocol between the host and a
+display. Display only uses the methods of Transport, so the protocol can
+run over a local serial port, a serial-over-IP bridge, or entirely in memory.
+"""
+
+import collections
+import errno
+import random
+import socket
+import time
+
+
+class Transport(object):
+    """
+    Interface of all transports. Timeouts are in seconds, and have the
+    semantics of pyserial: None blocks forever, 0 never blocks.
+    """
+
+    timeout = None
+    baudrate = 9600
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def read(self, size):
+        """
+        Read size bytes, returning fewer if the timeout expires first.
+        """
+        raise NotImplementedError
+
+    def write(self, buf):
+        """
+        Write buf, returning the number of bytes written.
+        """
+        raise NotImplementedError
+
+    def available(self):
+        """
+        Return the number of received bytes that can be read without
+        blocking, or 0 if unknown.
+        """
+        return 0
+
+    def flush(self):
+        """
+        Wait until all written data has been transmitted.
+        """
+        pass
+
+    def flush_input(self):
+        """
+        Discard all received data not yet read.
+        """
+        pass
+
+    def flush_output(self):
+        """
+        Discard all written data not yet transmitted.
+        """
+        pass
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+
+
+class SerialTransport(Transport):
+    """
+    Transport over a local serial port, using pyserial. pyserial is only
+    imported when the port is opened.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.ser = None
+
+    def open(self):
+        import serial
+        self.ser = serial.Serial(self.port)
+        self.ser.open()
+        self.ser.setParity('N')
+        self.ser.setByteSize(8)
+        self.ser.setStopbits(1)
+        self.set_baudrate(self.baudrate)
+        self.set_timeout(self.timeout)
+
+    def close(self):
+        self.ser.close()
+        self.ser = None
+
+    def read(self, size):
+        return self.ser.read(size)
+
+    def write(self, buf):
+        return self.ser.write(buf)
+
+    def available(self):
+        return self.ser.inWaiting()
+
+    def flush(self):
+        self.ser.flush()
+
+    def flush_input(self):
+        self.ser.flushInput()
+
+    def flush_output(self):
+        self.ser.flushOutput()
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        if self.ser:
+            self.ser.setTimeout(timeout)
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        if self.ser:
+            self.ser.setBaudrate(baudrate)
+
+
+class TCPTransport(Transport):
+    """
+    Transport over a TCP connection to a serial-over-IP bridge, which
+    forwards the byte stream to and from the display unchanged. The baud
+    rate of the serial side is configured on the bridge; set_baudrate only
+    records it.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.set_timeout(self.timeout)
+
+    def close(self):
+        self.sock.close()
+        self.sock = None
+
+    def read(self, size):
+        chunks = []
+        remaining = size
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while remaining:
+            if deadline is not None:
+                self.sock.settimeout(max(deadline - time.time(), 0))
+            try:
+                chunk = self.sock.recv(remaining)
+            except socket.timeout:
+                break
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                raise Exception('Connection closed by bridge')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def write(self, buf):
+        self.sock.settimeout(None)
+        self.sock.sendall(buf)
+        return len(buf)
+
+    def available(self):
+        try:
+            return len(self.sock.recv(4096, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+        except socket.error:
+            return 0
+
+    def flush_input(self):
+        timeout = self.timeout
+        self.timeout = 0
+        while self.read(4096):
+            pass
+        self.timeout = timeout
+
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport. Written bytes are handed to a device model, whose
+    replies become readable immediately; without a device model, written
+    bytes are echoed back.
+    """
+
+    def __init__(self, device=None):
+        self.device = device
+        self.rbuf = bytearray()
+
+    def open(self):
+        self.rbuf = bytearray()
+
+    def close(self):
+        pass
+
+    def read(self, size):
+        buf = str(self.rbuf[:size])
+        del self.rbuf[:size]
+        return buf
+
+    def write(self, buf):
+        if self.device is None:
+            self.rbuf += buf
+        else:
+            self.rbuf += self.device.write(buf)
+        return len(buf)
+
+    def available(self):
+        return len(self.rbuf)
+
+    def flush_input(self):
+        self.rbuf = bytearray()
+
+
+class FaultyTransport(Transport):
+    """
+    In-memory transport to a device model over a simulated serial line,
+    which injects faults into the replies: latency with uniform jitter,
+    dropped and corrupted bytes, and stalls of stall_time seconds.
+    Transmission takes 10 bits per byte at the baud rate.
+
+    When the baud rate differs from that of the device, as tracked by its
+    baudrate attribute, each side receives noise. Reads block in real time
+    up to the timeout, so timing behaviour can be measured. seed makes the
+    faults reproducible.
+    """
+
+    def __init__(self, device, latency=0.0, jitter=0.0, drop_rate=0.0, corrupt_rate=0.0,
+            stall_rate=0.0, stall_time=0.0, seed=None):
+        self.device = device
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.random = random.Random(seed)
+        self.queue = collections.deque()
+        self.rbuf = bytearray()
+        self.busy_until = 0
+        self.counters = {
+            'dropped': 0,
+            'corrupted': 0,
+            'stalls': 0,
+        }
+
+    def open(self):
+        self.queue.clear()
+        self.rbuf = bytearray()
+        self.busy_until = 0
+
+    def close(self):
+        pass
+
+    def device_baudrate(self):
+        return getattr(self.device, 'baudrate', self.baudrate)
+
+    def noise(self, size):
+        return bytearray(self.random.randrange(256) for i in xrange(size))
+
+    def write(self, buf):
+        now = time.time()
+        sent = now + len(buf) * 10.0 / self.baudrate
+        if self.baudrate != self.device_baudrate():
+            buf = self.noise(len(buf))
+        reply = bytearray()
+        for byte in bytearray(self.device.write(str(buf))):
+            if self.random.random() < self.drop_rate:
+                self.counters['dropped'] += 1
+                continue
+            if self.random.random() < self.corrupt_rate:
+                self.counters['corrupted'] += 1
+                byte ^= self.random.randrange(1, 256)
+            reply.append(byte)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.random.random() < self.stall_rate:
+            self.counters['stalls'] += 1
+            delay += self.stall_time
+        baudrate = self.device_baudrate()
+        arrival = max(sent + delay, self.busy_until) + len(reply) * 10.0 / baudrate
+        self.busy_until = arrival
+        if reply:
+            self.queue.append((arrival, baudrate, reply))
+        return len(buf)
+
+    def receive(self):
+        """
+        Move the replies that have arrived by now to the receive buffer.
+        """
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            arrival, baudrate, reply = self.queue.popleft()
+            if baudrate != self.baudrate:
+                reply = self.noise(len(reply))
+            self.rbuf += reply
+
+    def read(self, size):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            self.receive()
+            if len(self.rbuf) >= size:
+                break
+            if self.queue and (deadline is None or self.queue[0][0] <= deadline):
+                time.sleep(max(self.queue[0][0] - time.time(), 0))
+                continue
+            if deadline is not None:
+                time.sleep(max(deadline - time.time(), 0))
+                self.receive()
+            break
+        buf = str(self.rbuf[:size])
+        del self.rbuf[:size]
+        return buf
+
+    def available(self):
+        self.receive()
+        return len(self.rbuf)
+
+    def flush_input(self):
+        self.receive()
+        self.rbuf = bytearray()
@@ -1,6 +1,147 @@
+import contextlib
+import math
 import os
-import serial
 import struct
+import time
+
+import transport
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the reply stream lost framing: an unexpected byte, or a reply
+    that did not arrive in time.
+    """
+    pass
+
+
+class ReplyTimeout(ProtocolError):
+    """
+    Raised when a reply did not arrive, completely, within its deadline.
+    """
+    pass
+
+
+class LatencyModel(object):
+    """
+    Online model of command round trip times.
+
+    The round trip of a command is its wire time, derived from the number of
+    bytes sent and received at the current baud rate, plus the time the
+    device spends executing it. Execution time is tracked per opcode as a
+    smoothed mean and mean deviation, the same way TCP estimates its
+    retransmission timeout, and updated from every measured round trip.
+    """
+
+    BITS_PER_BYTE = 10
+    GAIN = 0.125
+    DEVIATION_GAIN = 0.25
+    DEVIATION_FACTOR = 4
+    GRANULARITY = 0.01
+    MIN_DEADLINE = 0.02
+    MAX_DEADLINE = 5
+    DEFAULT_EXECUTION = 0.01
+
+    def __init__(self, priors=None):
+        self.priors = priors or {}
+        self.estimates = {}
+
+    def wire_time(self, size, baudrate):
+        return size * self.BITS_PER_BYTE / float(baudrate)
+
+    def estimate(self, opcode):
+        """
+        Return the (mean, deviation) execution time of opcode.
+        """
+        if opcode in self.estimates:
+            return tuple(self.estimates[opcode])
+        prior = self.priors.get(opcode, self.DEFAULT_EXECUTION)
+        return (prior, prior)
+
+    def deadline(self, opcode, size, baudrate, delay=0):
+        """
+        Return the time to wait for the reply to a command of opcode, where
+        size is the number of bytes sent and received, and delay is any time
+        the command is known to spend on top of normal execution.
+        """
+        mean, deviation = self.estimate(opcode)
+        deadline = self.wire_time(size, baudrate) + mean + self.DEVIATION_FACTOR * deviation
+        deadline = min(max(deadline, self.MIN_DEADLINE), self.MAX_DEADLINE)
+        deadline = math.ceil(deadline / self.GRANULARITY) * self.GRANULARITY
+        return deadline + delay
+
+    def update(self, opcode, size, baudrate, elapsed):
+        """
+        Feed a measured round trip time into the model.
+        """
+        sample = max(elapsed - self.wire_time(size, baudrate), 0)
+        if opcode not in self.estimates:
+            self.estimates[opcode] = [sample, sample / 2]
+            return
+        estimate = self.estimates[opcode]
+        error = sample - estimate[0]
+        estimate[0] += self.GAIN * error
+        estimate[1] += self.DEVIATION_GAIN * (abs(error) - estimate[1])
+
+    def backoff(self, opcode):
+        """
+        Double the expected execution time of opcode after it timed out.
+        """
+        mean, deviation = self.estimate(opcode)
+        self.estimates[opcode] = [mean * 2, deviation * 2]
+
+
+class ReplyReader(object):
+    """
+    Buffered reader of the reply stream. Each read takes everything the
+    transport already has available, at least the bytes needed, so the
+    replies of many outstanding commands are usually decoded from one read.
+    Consumed bytes are dropped from the front of the buffer once more than
+    COMPACT_SIZE of them accumulate.
+    """
+
+    COMPACT_SIZE = 4096
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.buf = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.buf) - self.offset
+
+    def clear(self):
+        """
+        Discard all buffered bytes, returning how many there were.
+        """
+        size = len(self)
+        self.buf = bytearray()
+        self.offset = 0
+        return size
+
+    def fill(self, ser, size):
+        """
+        Read from ser until size bytes are buffered, or its timeout expires.
+        Returns True if they are.
+        """
+        missing = size - len(self)
+        if missing <= 0:
+            return True
+        if self.offset >= self.COMPACT_SIZE:
+            del self.buf[:self.offset]
+            self.offset = 0
+        self.buf += ser.read(max(missing, ser.available()))
+        self.counters['reads'] += 1
+        return len(self) >= size
+
+    def take(self, size):
+        """
+        Remove and return up to size buffered bytes.
+        """
+        data = str(self.buf[self.offset:self.offset+size])
+        self.offset += len(data)
+        return data
+
 
 class Display(object):
 
@@ -14,13 +155,54 @@ class Display(object):
     RES_X = -1
     RES_Y = -1
 
+    TIMEOUT = 5
+    RESYNC_WAIT = 0.5
+    RESYNC_ATTEMPTS = 3
+    RETRY_LIMIT = 2
+    timeout = TIMEOUT
+    NULL_COMMAND = '\x00\x00\x00'
+    WRITE_BUFFER_SIZE = 512
+
+    REPLY_ACK = 0
+    REPLY_WORD = 1
+    REPLY_WORDS = 2
+    REPLY_STRING = 3
+    REPLY_SIZES = {
+        REPLY_ACK: 1,
+        REPLY_WORD: 3,
+        REPLY_WORDS: 5,
+        REPLY_STRING: 35,
+    }
+
     ############################
     ###  Internal functions  ###
     ############################
 
-    def __init__(self, serial_port = None, serial_baudrate = 9600):
+    def __init__(self, serial_port = None, serial_baudrate = 9600, transport = None):
+        self.transport = transport
         self.set_serial_port(serial_port)
         self.set_serial_baudrate(serial_baudrate)
+        self.counters = {
+            'resyncs': 0,
+            'retries': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'writes': 0,
+            'bytes_written': 0,
+            'commands': 0,
+            'command_bytes': 0,
+            'reply_wait': 0.0,
+            'reads': 0,
+        }
+        self.reader = ReplyReader(self.counters)
+        self.latency = LatencyModel(self.LATENCY_PRIORS)
+        self.command = bytearray()
+        self.wbuf = bytearray()
+        self.pending = []
+        self.batching = 0
+        # Clip state last sent to the display, None while unknown
+        self.clipping = None
+        self.clip_window = None
 
     def set_serial_port(self, serial_port):
         self.serial_port = serial_port
@@ -28,18 +210,31 @@ class Display(object):
     def set_serial_baudrate(self, serial_baudrate):
         self.serial_baudrate = int(serial_baudrate)
 
+    def set_timeout(self, timeout):
+        if timeout == self.timeout:
+            return
+        self.timeout = timeout
+        self.ser.set_timeout(timeout)
+
     def detect_serial_baudrate(self):
-        self.ser.setTimeout(0)
+        baudrate = self.serial_baudrate
         for index, rate in self.BAUD_RATE_INDEX:
-            self.ser.setBaudrate(rate)
-            self.ser.flushInput()
+            self.ser.set_baudrate(rate)
+            self.ser.flush_input()
+            self.serial_baudrate = rate
+            # Probes at other rates reach the device as noise, which may
+            # have left a partial command behind. At the wrong rate the
+            # marker reply is noise as well, so a single short wait will do.
+            size = len(self.NULL_COMMAND + self.RESYNC_MARKER) + 2 * self.REPLY_SIZES[self.REPLY_WORD]
+            if not self.resync(attempts=1, wait=self.latency.deadline(self.GFX_GET, size, rate)):
+                continue
             try:
-                if self.sys_GetModel():
-                    self.serial_baudrate = rate
-                    self.ser.setTimeout(5)
+                if self.transact(self.GET_DISPLAY_MODEL, self.REPLY_STRING, retries=0):
                     return rate
             except:
                 pass
+        self.serial_baudrate = baudrate
+        self.ser.set_baudrate(baudrate)
         raise Exception('No match in any baud rate')
 
     @staticmethod
@@ -64,89 +259,327 @@ class Display(object):
         print "export PYCASO_SERIAL_BAUDRATE=%d" % target
         return True
 
-    def get_ack(self):
+    def get_ack(self, size=1):
         """
         Returns True if serial response was an ACK reply, False if not.
+        Resynchronizes and raises ProtocolError on any other reply. size is
+        that of the whole reply expected, which is read at once when it
+        arrives in time.
         """
-        ack = self.ser.read(1)
+        self.reader.fill(self.ser, size)
+        ack = self.reader.take(1)
         if ack == self.ACK:
             return True
-        self.ser.flushInput()
         if ack == self.ERR:
             return False
-        raise Exception("Unknown reply: '%s'" % ack.encode('hex'))
+        self.resync()
+        if not ack:
+            self.counters['timeouts'] += 1
+            raise ReplyTimeout('No reply')
+        raise ProtocolError("Unknown reply: '%s'" % ack.encode('hex'))
+
+    def recv(self, size):
+        """
+        Read exactly size bytes from serial. Resynchronizes and raises
+        ProtocolError on a short read.
+        """
+        self.reader.fill(self.ser, size)
+        buf = self.reader.take(size)
+        if len(buf) != size:
+            self.resync()
+            self.counters['timeouts'] += 1
+            raise ReplyTimeout('Short reply: expected %d bytes, got %d' % (size, len(buf)))
+        return buf
+
+    def recv_reply(self, reply, opcode=None):
+        """
+        Read the reply to a command: an ACK, followed by a payload depending
+        on the reply type. Commands in REPLY_SHAPES are read with the reply
+        type the device actually sends; a payload the caller did not ask
+        for is discarded.
+        """
+        shape = self.REPLY_SHAPES.get(opcode, reply)
+        # Of strings, only the length is known to come
+        if not self.get_ack(self.REPLY_SIZES[self.REPLY_WORD if shape == self.REPLY_STRING else shape]):
+            raise Exception('Command error, received ERR')
+        result = self.recv_payload(shape)
+        if reply == self.REPLY_ACK:
+            return True
+        return result
+
+    def recv_payload(self, reply):
+        """
+        Read the payload following the ACK of a reply.
+        """
+        if reply == self.REPLY_ACK:
+            return True
+        if reply == self.REPLY_WORD:
+            return self.recv_word()
+        if reply == self.REPLY_WORDS:
+            return struct.unpack('>HH', self.recv(4))
+        return self.recv(self.recv_word())
 
     def send(self, buf):
         """
-        Write buffer to serial device.
+        Append buffer to the command being assembled. The command is written
+        to the serial device as a whole, when it is complete.
         """
+        self.command += buf
+        return True
+
+    def write(self):
+        """
+        Write the write buffer to serial device.
+        """
+        if not self.wbuf:
+            return True
+        buf = self.wbuf
+        self.wbuf = bytearray()
         assert self.ser.write(buf) == len(buf)
         self.ser.flush()
+        self.counters['writes'] += 1
+        self.counters['bytes_written'] += len(buf)
         return True
 
+    def flush(self):
+        """
+        Write all buffered commands to serial device, and check the ACKs of
+        commands deferred by batch(). Throws an exception if any of them
+        received ERR.
+        """
+        self.wbuf += self.command
+        self.command = bytearray()
+        pending = self.pending
+        self.pending = []
+        attempts = self.RETRY_LIMIT + 1
+        errors = 0
+        for attempt in xrange(attempts):
+            if attempt:
+                self.counters['retries'] += 1
+            self.write()
+            start = time.time()
+            try:
+                shapes = [self.REPLY_SHAPES.get(command[:2], self.REPLY_ACK) for command, idempotent, deadline in pending]
+                if pending:
+                    # Read all replies at once, if they arrive in time. Replies
+                    # still missing after that are waited for one by one.
+                    self.set_timeout(max(deadline for command, idempotent, deadline in pending))
+                    self.reader.fill(self.ser, sum(self.REPLY_SIZES[shape] for shape in shapes))
+                while pending:
+                    self.set_timeout(pending[0][2])
+                    if self.get_ack():
+                        self.recv_payload(shapes[0])
+                    else:
+                        errors += 1
+                    pending.pop(0)
+                    shapes.pop(0)
+                break
+            except ProtocolError:
+                if attempt == attempts - 1 or not all(idempotent for command, idempotent, deadline in pending):
+                    raise
+                for command, idempotent, deadline in pending:
+                    self.wbuf += command
+            finally:
+                self.counters['reply_wait'] += time.time() - start
+        if errors:
+            raise Exception('Command error, received ERR for %d batched commands' % errors)
+        return True
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager deferring the ACKs of commands that return nothing
+        else. Such commands return True immediately, and are written in as
+        few writes as possible: when a command needs its reply, when
+        WRITE_BUFFER_SIZE bytes are buffered, on flush() or at the end of the
+        outermost batch.
+        """
+        self.batching += 1
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+        if not self.batching:
+            self.flush()
+
+    def transact(self, buf, reply=REPLY_ACK, idempotent=None, delay=0, retries=None):
+        """
+        Write a complete command to serial and return its decoded reply.
+        The reply must arrive within the deadline given by the latency model,
+        plus delay seconds. Idempotent commands are retried up to retries
+        times, RETRY_LIMIT by default, when the reply stream loses framing.
+        """
+        buf = str(self.command + buf)
+        self.command = bytearray()
+        opcode = buf[:2]
+        if idempotent is None:
+            idempotent = opcode in self.IDEMPOTENT_COMMANDS
+        size = len(buf) + self.REPLY_SIZES[reply]
+        self.counters['commands'] += 1
+        self.counters['command_bytes'] += len(buf)
+        deadline = self.latency.deadline(opcode, size, self.serial_baudrate, delay)
+        if self.batching and reply == self.REPLY_ACK:
+            self.pending.append((buf, idempotent, deadline))
+            self.wbuf += buf
+            if len(self.wbuf) >= self.WRITE_BUFFER_SIZE:
+                self.flush()
+            return True
+        if self.pending:
+            self.flush()
+        if retries is None:
+            retries = self.RETRY_LIMIT
+        attempts = retries + 1 if idempotent else 1
+        for attempt in xrange(attempts):
+            if attempt:
+                self.counters['retries'] += 1
+                # Allow for the backoff from the attempt that timed out
+                deadline = self.latency.deadline(opcode, size, self.serial_baudrate, delay)
+            self.set_timeout(deadline)
+            start = time.time()
+            self.wbuf += buf
+            self.write()
+            try:
+                result = self.recv_reply(reply, opcode)
+            except ProtocolError as e:
+                # Corrupted replies arrive on time, and say nothing about it
+                if isinstance(e, ReplyTimeout):
+                    self.latency.backoff(opcode)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            finally:
+                self.counters['reply_wait'] += time.time() - start
+            self.latency.update(opcode, size, self.serial_baudrate, time.time() - start - delay)
+            return result
+
     def send_ack(self, buf):
         """
         Write buffer to serial device and check for ACK. Throws an exception if ACK is not received.
         """
-        assert self.ser.write(buf) == len(buf)
-        self.ser.flush()
-        if not self.get_ack():
-            raise Exception('Command error, received ERR')
-        return True
+        return self.transact(buf)
 
     def recv_word(self):
         """
         Return a WORD value from serial.
         """
-        return struct.unpack('>H', self.ser.read(2))[0]
+        return struct.unpack('>H', self.recv(2))[0]
 
     def send_args(self, *args):
         """
         Send the WORDs in args.
         """
-        buf = struct.pack('>'+(len(args)*'H'), *args)
+        buf = self.pack_words(args)
         return self.send(buf)
 
+    @staticmethod
+    def pack_words(args):
+        """
+        Encode args as WORDs. Negative values, such as coordinates left of or
+        above the screen, are sent in two's complement. Raises struct.error
+        for values that fit in neither a signed nor an unsigned WORD.
+        """
+        words = []
+        for arg in args:
+            arg = int(arg)
+            if not -0x8000 <= arg <= 0xffff:
+                raise struct.error('WORD out of range: %d' % arg)
+            words.append(arg & 0xffff)
+        return struct.pack('>'+(len(words)*'H'), *words)
+
     def send_args_ack(self, buf, *args):
         """
         Send buf along with the WORDs in args, expecting an ACK response.
         """
-        buf += struct.pack('>'+(len(args)*'H'), *args)
-        return self.send_ack(buf)
+        buf += self.pack_words(args)
+        return self.transact(buf)
 
     def send_args_recv_word(self, buf, *args):
         """
         Send buf along with the WORDs in args, expecting an ACK response and a WORD.
         """
-        self.send_args_ack(buf, *args)
-        return self.recv_word()
+        buf += self.pack_words(args)
+        return self.transact(buf, self.REPLY_WORD)
+
+    def resync(self, attempts=None, wait=None):
+        """
+        Re-establish the command boundary after a framing loss. The null
+        command completes any partial command left in the device, and is
+        followed by RESYNC_MARKER, whose reply is known. Input is discarded
+        until that reply arrives, so late replies to earlier commands cannot
+        be taken for the replies to later ones. The marker is sent up to
+        attempts times, RESYNC_ATTEMPTS by default, waiting up to wait
+        seconds, RESYNC_WAIT by default, for each. Returns True if the
+        boundary was found.
+        """
+        self.counters['resyncs'] += 1
+        if attempts is None:
+            attempts = self.RESYNC_ATTEMPTS
+        if wait is None:
+            wait = self.RESYNC_WAIT
+        discarded = self.reader.clear()
+        found = False
+        for attempt in xrange(attempts):
+            self.ser.write(self.NULL_COMMAND + self.RESYNC_MARKER)
+            self.ser.flush()
+            buf = bytearray()
+            deadline = time.time() + wait
+            while not found and time.time() < deadline:
+                self.ser.set_timeout(max(deadline - time.time(), 0))
+                data = self.ser.read(max(self.ser.available(), 1))
+                if not data:
+                    break
+                buf += data
+                found = self.is_resync_reply(buf[-6:])
+            if found:
+                discarded += len(buf) - 6
+                break
+            discarded += len(buf)
+        self.counters['discarded'] += discarded
+        self.ser.set_timeout(self.timeout)
+        return found
+
+    def is_resync_reply(self, buf):
+        """
+        Returns True if buf is the reply to RESYNC_MARKER: twice an ACK and
+        the maximum X coordinate, which must match RES_X once known.
+        """
+        if len(buf) != 6 or buf[0] != ord(self.ACK) or buf[3] != ord(self.ACK) or buf[1:3] != buf[4:6]:
+            return False
+        return self.RES_X < 0 or struct.unpack('>H', str(buf[1:3]))[0] == self.RES_X - 1
 
     def connect(self):
-        if not self.serial_port:
-            raise Exception("Serial port not set. Use set_serial_port() before calling connect().")
         if self.ser:
             raise Exception("Serial port already open.")
-        self.ser = serial.Serial(self.serial_port)
+        if self.transport:
+            self.ser = self.transport
+        elif self.serial_port:
+            self.ser = transport.SerialTransport(self.serial_port)
+        else:
+            raise Exception("Serial port not set. Use set_serial_port() before calling connect().")
         self.ser.open()
-        self.ser.setBaudrate(self.serial_baudrate)
-        self.ser.setParity('N')
-        self.ser.setByteSize(8)
-        self.ser.setStopbits(1)
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.setTimeout(0)
+        self.ser.set_baudrate(self.serial_baudrate)
+        self.ser.flush_input()
+        self.ser.flush_output()
+        self.timeout = None
+        self.set_timeout(0)
         self.ser.read(1024)
-        self.ser.setTimeout(5)
+        self.reader.clear()
+        self.set_timeout(self.TIMEOUT)
+        self.clipping = None
+        self.clip_window = None
         return True
 
     def reset(self):
-        self.ser.setTimeout(0)
-        self.ser.write('\x00\x00\x00')
+        self.ser.set_timeout(0)
+        self.ser.write(self.NULL_COMMAND)
         self.ser.read(1024)
-        self.ser.setTimeout(5)
+        self.reader.clear()
+        self.ser.set_timeout(self.timeout)
         return True
 
     def close(self):
+        if self.pending or self.wbuf:
+            self.flush()
         self.ser.close()
         self.ser = None
         return True
@@ -156,6 +589,37 @@ class Display(object):
     ###  Some helper API functions  ###
     ###################################
 
+    def set_clip(self, window):
+        """
+        Clip drawing to window, given as (x1, y1, x2, y2), or disable
+        clipping if window is None. Only sends the commands needed to change
+        the clip state last sent.
+        """
+        if window is None:
+            if self.clipping is not False:
+                self.gfx_Clipping(False)
+            return True
+        if self.clip_window != tuple(window):
+            self.gfx_ClipWindow(window[:2], window[2:])
+        if self.clipping is not True:
+            self.gfx_Clipping(True)
+        return True
+
+    def restore_clip(self, clipping, window):
+        """
+        Restore the clip state saved from clipping and clip_window. When
+        clipping was on with a window that is not known, as after
+        gfx_SetClipRegion, the window cannot be restored, but clipping is
+        kept on.
+        """
+        if (self.clipping, self.clip_window) == (clipping, window):
+            return True
+        if clipping and window is None:
+            if self.clipping is not True:
+                self.gfx_Clipping(True)
+            return True
+        return self.set_clip(window if clipping else None)
+
     def detect_dimensions(self):
         self.RES_X = self.gfx_Get(self.GFX_GET_X_MAX) + 1
         self.RES_Y = self.gfx_Get(self.GFX_GET_Y_MAX) + 1
@@ -200,16 +664,13 @@ class Display(object):
         if len(string) > 511:
             string = string[:511]
         string += '\0'
-        self.send_ack(self.PUT_STR + string)
-        return self.recv_word()
+        return self.transact(self.PUT_STR + string, self.REPLY_WORD)
 
     def charwidth(self, char):
-        self.send_ack(self.CHAR_WIDTH + struct.pack('>B', ord(char)))
-        return self.recv_word()
+        return self.transact(self.CHAR_WIDTH + struct.pack('>B', ord(char)), self.REPLY_WORD)
 
     def charheight(self, char):
-        self.send_ack(self.CHAR_HEIGHT + struct.pack('>B', ord(char)))
-        return self.recv_word()
+        return self.transact(self.CHAR_HEIGHT + struct.pack('>B', ord(char)), self.REPLY_WORD)
 
     def txt_FGcolour(self, colour):
         return self.send_args_recv_word(self.TEXT_FGCOLOUR, colour)
@@ -370,8 +831,7 @@ class Display(object):
         return self.send_args_ack(self.TRIANGLE_FILLED, point1[0], point1[1], point2[0], point2[1], point3[0], point3[1], colour)
 
     def gfx_Orbit(self, angle, distance):
-        self.send_args_ack(self.ORBIT, angle, distance)
-        return struct.unpack('>HH', self.ser.read(4))
+        return self.transact(self.ORBIT + struct.pack('>HH', angle, distance), self.REPLY_WORDS)
 
     def gfx_PutPixel(self, point, colour):
         return self.send_args_ack(self.PUT_PIXEL, point[0], point[1], colour)
@@ -386,13 +846,19 @@ class Display(object):
         return self.send_args_ack(self.LINE_TO, point[0], point[1])
 
     def gfx_Clipping(self, enable):
-        return self.send_args_ack(self.CLIPPING, bool(enable))
+        result = self.send_args_ack(self.CLIPPING, bool(enable))
+        self.clipping = bool(enable)
+        return result
 
     def gfx_ClipWindow(self, top_left, bottom_right):
-        return self.send_args_ack(self.CLIP_WINDOW, top_left[0], top_left[1], bottom_right[0], bottom_right[1])
+        result = self.send_args_ack(self.CLIP_WINDOW, top_left[0], top_left[1], bottom_right[0], bottom_right[1])
+        self.clip_window = tuple(top_left) + tuple(bottom_right)
+        return result
 
     def gfx_SetClipRegion(self):
-        return self.send_ack(self.SET_CLIP_REGION)
+        result = self.send_ack(self.SET_CLIP_REGION)
+        self.clip_window = None
+        return result
 
     def gfx_Ellipse(self, point, xrad, yrad, colour):
         return self.send_args_ack(self.ELLIPSE, point[0], point[1], xrad, yrad, colour)
@@ -410,7 +876,7 @@ class Display(object):
         text += '\x00'
         self.send(self.BUTTON)
         self.send_args(state, point[0], point[1], button_colour, text_colour, font, text_width, text_height)
-        return self.send_ack(text)
+        return self.transact(text)
 
     def gfx_Panel(self, state, point, width, height, colour):
         if state != self.PANEL_STATE_RECESSED and state != self.PANEL_STATE_RAISED:
@@ -501,9 +967,12 @@ class Display(object):
             if rate == baudrate:
                 if rate not in self.SUPPORTED_BAUD_RATES:
                     raise Exception('Baud rate is supported by device, but probably not by OS.')
-                self.ser.write(self.SET_BAUD_RATE + struct.pack('>H', index))
+                self.flush()
+                buf = self.SET_BAUD_RATE + struct.pack('>H', index)
+                self.set_timeout(self.latency.deadline(self.SET_BAUD_RATE, len(buf) + 1, baudrate))
+                self.ser.write(buf)
                 self.ser.flush()
-                self.ser.setBaudrate(baudrate)
+                self.ser.set_baudrate(baudrate)
                 self.serial_baudrate = baudrate
                 return self.get_ack()
         raise Exception("Unsupported baud rate.")
@@ -516,7 +985,7 @@ class Display(object):
     SLEEP = '\xff\x3b'
 
     def sys_Sleep(self, seconds):
-        return self.send_args_recv_word(self.SLEEP, seconds)
+        return self.transact(self.SLEEP + struct.pack('>H', seconds), self.REPLY_WORD, delay=seconds)
 
 
     ####################################
@@ -561,6 +1030,51 @@ class Display(object):
     GET_DISPLAY_MODEL = '\x00\x1a'
 
     def sys_GetModel(self):
-        c = self.send_args_recv_word(self.GET_DISPLAY_MODEL)
-        return self.ser.read(c)
+        return self.transact(self.GET_DISPLAY_MODEL, self.REPLY_STRING)
+
+
+    ####################################
+    ###  Protocol resynchronization  ###
+    ####################################
+
+    # Commands that leave the display in the same state no matter how many
+    # times they are executed, and return the same reply each time, and thus
+    # can be retried after a framing loss. Setters that return the previous
+    # value are not: a retry of one that did run returns the new value.
+    IDEMPOTENT_COMMANDS = frozenset([
+        MOVE_CURSOR, CHAR_WIDTH, CHAR_HEIGHT, CLEAR_SCREEN, CHANGE_COLOUR,
+        CIRCLE, CIRCLE_FILLED, LINE, RECTANGLE, RECTANGLE_FILLED, POLYLINE,
+        POLYGON, POLYGON_FILLED, TRIANGLE, TRIANGLE_FILLED, ORBIT, PUT_PIXEL,
+        GET_PIXEL, MOVE_TO, CLIPPING, CLIP_WINDOW, SET_CLIP_REGION, ELLIPSE,
+        ELLIPSE_FILLED, PANEL, SLIDER, GFX_SET, GFX_GET, TOUCH_DETECT_REGION,
+        BUTTON, GET_DISPLAY_MODEL,
+    ])
+
+    # Sent to mark the command boundary on resync: two gfx_Get(GFX_GET_X_MAX)
+    RESYNC_MARKER = 2 * (GFX_GET + struct.pack('>H', GFX_GET_X_MAX))
+
+    # Commands whose reply differs from the documentation, with the reply
+    # type they actually get. See gfx_Slider().
+    REPLY_SHAPES = {
+        SLIDER: REPLY_WORD,
+    }
+
+    # Initial guesses of device execution time, in seconds, for commands that
+    # are known to be slow. Replaced by measurements as soon as they exist.
+    LATENCY_PRIORS = {
+        CLEAR_SCREEN: 0.2,
+        CIRCLE_FILLED: 0.1,
+        RECTANGLE_FILLED: 0.1,
+        POLYGON_FILLED: 0.1,
+        TRIANGLE_FILLED: 0.1,
+        ELLIPSE_FILLED: 0.1,
+        BUTTON: 0.05,
+        PANEL: 0.05,
+        SLIDER: 0.05,
+        SCREEN_COPY_PASTE: 0.1,
+        CHANGE_COLOUR: 0.2,
+        SCREEN_MODE: 0.2,
+        TOUCH_SET: 0.05,
+        SET_BAUD_RATE: 0.1,
+    }
 
@@ -2,7 +2,88 @@
 UI widget library for the ulcd43pct Display class.
 """
 
+import array
 import math
+import time
+import weakref
+
+
+class WidgetStore(object):
+    """
+    Array-backed storage for the geometry and flags of widgets, indexed by
+    widget id. Ids of widgets that have been garbage collected are reused.
+    """
+
+    DIRTY = 1
+    UNFIT = 2
+    UPDATED = 4
+
+    def __init__(self):
+        self.geometry = array.array('i')
+        self.flags = bytearray()
+        self.refs = {}
+        self.free = []
+        # Incremented whenever draw_dirty() fits a widget
+        self.layouts = 0
+
+    def allocate(self, widget):
+        if self.free:
+            id = self.free.pop()
+        else:
+            id = len(self.flags)
+            self.flags.append(0)
+            self.geometry.extend((0, 0, 0, 0))
+        self.refs[id] = weakref.ref(widget, lambda ref, id=id: self.release(id))
+        return id
+
+    def release(self, id):
+        del self.refs[id]
+        self.free.append(id)
+
+    def __len__(self):
+        return len(self.refs)
+
+
+STORE = WidgetStore()
+
+# The active Profiler, if any.
+PROFILER = None
+
+
+def intersection(a, b):
+    """
+    Return the intersection of the rectangles a and b, or None if they do
+    not overlap. A rectangle of None is unbounded.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    if x1 > x2 or y1 > y2:
+        return None
+    return (x1, y1, x2, y2)
+
+
+def clip(display, screen, envelope, visible):
+    """
+    Make sure drawing inside envelope is limited to visible, changing the
+    clip state of display only if the current one does not already do so.
+    """
+    if display.clipping is False:
+        current = intersection(screen, envelope)
+    elif display.clipping and display.clip_window is not None:
+        current = intersection(intersection(screen, display.clip_window), envelope)
+    else:
+        current = ()
+    if current == visible:
+        return
+    if visible == intersection(screen, envelope):
+        display.set_clip(None)
+    else:
+        display.set_clip(visible)
+
 
 class Widget(object):
     ORIENTATION_SINGLE = 0
@@ -10,49 +91,169 @@ class Widget(object):
     ORIENTATION_VERTICAL = 2
     ORIENTATION_MATRIX = 3
 
+    # Whether the widget responds to touches even without on_touch
+    INTERACTIVE = False
+
+    __slots__ = ('id', 'key', 'children', 'parent', 'display', 'orientation', 'on_touch', '__weakref__')
+
     def __init__(self, **kwargs):
+        self.id = STORE.allocate(self)
+        self.key = None
         self.children = []
         self.parent = None
-        self.envelope = None
         self.dirty = True
         self.children_fits = False
         self.orientation = self.ORIENTATION_SINGLE
+        self.on_touch = None
 
+        envelope = kwargs.pop('envelope', None)
         for key, value in kwargs.iteritems():
             setattr(self, key, value)
-        if not self.envelope:
+        if not envelope:
             if self.parent:
-                self.envelope = self.parent.envelope
+                envelope = self.parent.envelope
             else:
-                self.envelope = (0, 0, 0, 0)
+                envelope = (0, 0, 0, 0)
+        self.envelope = envelope
+
+    def _get_envelope(self):
+        i = self.id * 4
+        return tuple(STORE.geometry[i:i+4])
+
+    def _set_envelope(self, envelope):
+        i = self.id * 4
+        geometry = STORE.geometry
+        for index, value in enumerate(envelope or (0, 0, 0, 0)):
+            geometry[i+index] = int(value)
+
+    envelope = property(_get_envelope, _set_envelope)
+
+    def _get_dirty(self):
+        return bool(STORE.flags[self.id] & WidgetStore.DIRTY)
+
+    def _set_dirty(self, dirty):
+        if dirty:
+            STORE.flags[self.id] |= WidgetStore.DIRTY
+        else:
+            STORE.flags[self.id] &= ~WidgetStore.DIRTY
+
+    dirty = property(_get_dirty, _set_dirty)
+
+    def _get_children_fits(self):
+        return not STORE.flags[self.id] & WidgetStore.UNFIT
+
+    def _set_children_fits(self, children_fits):
+        if children_fits:
+            STORE.flags[self.id] &= ~WidgetStore.UNFIT
+        else:
+            STORE.flags[self.id] |= WidgetStore.UNFIT
+
+    children_fits = property(_get_children_fits, _set_children_fits)
 
     def _draw(self, display):
         pass
 
+    def _update(self, display):
+        """
+        Repaint what changed since the last draw, after mark_updated().
+        """
+        self._draw(display)
+
+    def interactive(self):
+        return self.INTERACTIVE or self.on_touch is not None
+
+    def touch(self, status, point):
+        """
+        Handle a touch at point, with a TOUCH_STATUS_* status.
+        """
+        if self.on_touch is not None:
+            self.on_touch(self, status, point)
+
+    def walk(self):
+        """
+        Iterate over this widget and all its descendants, depth first.
+        """
+        stack = [self]
+        while stack:
+            widget = stack.pop()
+            yield widget
+            stack.extend(reversed(widget.children))
+
     def draw(self, display):
         self.mark_dirty()
         self.draw_dirty(display)
 
     def draw_dirty(self, display):
-        if not self.children_fits:
-            self.fit_children()
-        if self.dirty:
-            self._draw(display)
-        self.dirty = False
-        for child in self.children:
-            child.draw_dirty(display)
+        """
+        Draw all dirty and updated widgets of the tree. Drawing a dirty
+        widget marks its children dirty, as it may paint over them. Subtrees
+        outside the screen, or outside the envelope of their parent, are
+        skipped and stay dirty. Widgets that are only partly visible are
+        drawn with the clip window set to their visible part, and the clip
+        state is restored afterwards. If clipping is on with a window that
+        is not known, as after gfx_SetClipRegion, it is left alone rather
+        than lost.
+        """
+        flags = STORE.flags
+        profiler = PROFILER
+        clipping, clip_window = display.clipping, display.clip_window
+        unknown = clipping and clip_window is None
+        screen = None
+        if display.RES_X > 0 and display.RES_Y > 0:
+            screen = (0, 0, display.RES_X - 1, display.RES_Y - 1)
+        stack = [(self, screen)]
+        while stack:
+            widget, viewport = stack.pop()
+            envelope = widget.envelope
+            visible = intersection(viewport, envelope)
+            if visible is None:
+                continue
+            if flags[widget.id] & WidgetStore.UNFIT:
+                if profiler:
+                    profiler.start(display)
+                widget.fit_children()
+                STORE.layouts += 1
+                if profiler:
+                    profiler.stop(display, widget, 'fit_children')
+            if flags[widget.id] & (WidgetStore.DIRTY | WidgetStore.UPDATED):
+                if profiler:
+                    profiler.start(display)
+                if not unknown:
+                    clip(display, screen, envelope, visible)
+                if flags[widget.id] & WidgetStore.DIRTY:
+                    widget._draw(display)
+                    # The widget may have painted over its children
+                    for child in widget.children:
+                        flags[child.id] |= WidgetStore.DIRTY
+                else:
+                    widget._update(display)
+                if profiler:
+                    profiler.stop(display, widget, '_draw')
+            flags[widget.id] &= ~(WidgetStore.DIRTY | WidgetStore.UPDATED)
+            stack.extend((child, visible) for child in reversed(widget.children))
+        display.restore_clip(clipping, clip_window)
 
     def mark_dirty(self):
-        self.dirty = True
-        for child in self.children:
-            child.mark_dirty()
+        flags = STORE.flags
+        for widget in self.walk():
+            flags[widget.id] |= WidgetStore.DIRTY
+
+    def mark_updated(self):
+        """
+        Mark the content of this widget, but not its children, as changed.
+        Unlike mark_dirty(), it is repainted with _update().
+        """
+        STORE.flags[self.id] |= WidgetStore.UPDATED
 
     def unfit(self):
-        self.children_fits = False
-        for child in self.children:
-            child.unfit()
+        flags = STORE.flags
+        for widget in self.walk():
+            flags[widget.id] |= WidgetStore.UNFIT
 
     def set_envelope(self, envelope=None):
+        envelope = tuple(int(value) for value in envelope or (0, 0, 0, 0))
+        if envelope == self.envelope:
+            return
         self.envelope = envelope
         self.mark_dirty()
         self.unfit()
@@ -64,8 +265,17 @@ class Widget(object):
         child.display = self.display
         child.envelope = self.envelope
         self.children.append(child)
+        # Drawing this widget marks every child, which it may paint over.
+        STORE.flags[self.id] |= WidgetStore.DIRTY | WidgetStore.UNFIT
+        child.mark_dirty()
+        child.unfit()
+
+    def remove_child(self, child):
+        self.children.remove(child)
+        child.parent = None
+        # The parent repaints over the removed child, and its siblings move.
         self.mark_dirty()
-        self.unfit()
+        STORE.flags[self.id] |= WidgetStore.UNFIT
 
     def fit_children(self):
         self.children_fits = True
@@ -113,6 +323,8 @@ class Widget(object):
 
 class Canvas(Widget):
 
+    __slots__ = ('background', 'active')
+
     def __init__(self, display, **kwargs):
         self.background = 0
         self.active = False
@@ -123,8 +335,400 @@ class Canvas(Widget):
         display.gfx_RectangleFilled(self.envelope[:2], self.envelope[2:], self.background)
 
 
+class Element(object):
+    """
+    Description of a widget for reconcile(): its class, the properties to
+    set on it and the elements of its children. key identifies the widget
+    among its siblings; widgets without a key are matched by position.
+    """
+
+    def __init__(self, type, key=None, children=(), **props):
+        self.type = type
+        self.key = key
+        self.children = list(children)
+        self.props = props
+
+
+def update(widget, props):
+    """
+    Set the properties of widget that differ from props. Properties with a
+    set_<name>() method, such as ValueWidget.set_value(), are set through it;
+    other changes mark the widget dirty and unfit. Callables, such as
+    on_touch, are set without marking anything.
+    """
+    changed = False
+    for name, value in props.iteritems():
+        if getattr(widget, name) == value:
+            continue
+        setter = getattr(widget, 'set_' + name, None)
+        if setter is not None:
+            setter(value)
+        else:
+            setattr(widget, name, value)
+            changed = changed or not callable(value)
+    if changed:
+        widget.mark_dirty()
+        STORE.flags[widget.id] |= WidgetStore.UNFIT
+
+
+def reconcile(parent, elements):
+    """
+    Make the children of parent match elements, a list of Element, reusing
+    the existing widgets of the same key and class. Only widgets whose
+    properties changed, and parents whose children changed, are marked for
+    drawing; the rest of the tree is left as it is.
+    """
+    stack = [(parent, elements)]
+    while stack:
+        parent, elements = stack.pop()
+        existing = {}
+        for index, child in enumerate(parent.children):
+            existing[child.key if child.key is not None else ('#', index)] = child
+        children = []
+        for index, element in enumerate(elements):
+            child = existing.pop(element.key if element.key is not None else ('#', index), None)
+            if child is None or type(child) is not element.type:
+                if child is not None:
+                    child.parent = None
+                child = element.type(**element.props)
+                child.key = element.key
+                child.parent = parent
+                child.display = parent.display
+                if 'envelope' not in element.props:
+                    child.envelope = parent.envelope
+            else:
+                update(child, element.props)
+            children.append(child)
+            stack.append((child, element.children))
+        if children != parent.children:
+            for child in existing.itervalues():
+                child.parent = None
+            parent.children = children
+            parent.mark_dirty()
+            STORE.flags[parent.id] |= WidgetStore.UNFIT
+
+
+class FrameScheduler(object):
+    """
+    Renders a Canvas at most once per frame. Invalidations arriving within
+    one frame collapse into a single draw_dirty() pass, which is sent as one
+    Display.batch().
+
+    The frame rate starts at max_fps, and adapts to the measured serial
+    throughput so that an average frame fits in one frame interval, with
+    some headroom. With sync_frame_delay, the device frame delay is kept
+    equal to the frame interval using gfx_FrameDelay.
+    """
+
+    MIN_FPS = 1
+    HEADROOM = 1.25
+    GAIN = 0.25
+
+    def __init__(self, canvas, max_fps=30, sync_frame_delay=False):
+        self.canvas = canvas
+        self.display = canvas.display
+        self.max_fps = max_fps
+        self.fps = max_fps
+        self.sync_frame_delay = sync_frame_delay
+        self.frame_delay = None
+        self.pending = False
+        self.next_frame = 0
+        self.frame_size = None
+        self.throughput = None
+        self.frames = 0
+        self.coalesced = 0
+
+    def invalidate(self, widget=None):
+        """
+        Mark widget dirty, and request a frame. Without widget, only a frame
+        is requested, for widgets that have already been marked.
+        """
+        if widget is not None:
+            widget.mark_dirty()
+        if self.pending:
+            self.coalesced += 1
+        self.pending = True
+
+    def interval(self):
+        return 1.0 / self.fps
+
+    def poll(self, now=None):
+        """
+        Render a frame if one has been requested and is due. Returns True if
+        a frame was rendered.
+        """
+        if now is None:
+            now = time.time()
+        if not self.pending or now < self.next_frame:
+            return False
+        self.render()
+        self.next_frame = now + self.interval()
+        return True
+
+    def wait(self):
+        """
+        Sleep until the next frame is due, then render it if requested.
+        """
+        delay = self.next_frame - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self.poll()
+
+    def render(self):
+        self.pending = False
+        written = self.display.counters['bytes_written']
+        start = time.time()
+        with self.display.batch():
+            self.canvas.draw_dirty(self.display)
+        self.frames += 1
+        self.adapt(self.display.counters['bytes_written'] - written, time.time() - start)
+
+    def adapt(self, size, elapsed):
+        """
+        Update the frame size and throughput estimates with a rendered frame,
+        and derive the frame rate from them.
+        """
+        if not size or elapsed <= 0:
+            return
+        throughput = size / elapsed
+        if self.frame_size is None:
+            self.frame_size = size
+            self.throughput = throughput
+        else:
+            self.frame_size += self.GAIN * (size - self.frame_size)
+            self.throughput += self.GAIN * (throughput - self.throughput)
+        fps = self.throughput / (self.frame_size * self.HEADROOM)
+        self.fps = min(max(fps, self.MIN_FPS), self.max_fps)
+        if self.sync_frame_delay:
+            frame_delay = int(round(1000 * self.interval()))
+            if frame_delay != self.frame_delay:
+                self.display.gfx_FrameDelay(frame_delay)
+                self.frame_delay = frame_delay
+
+
+class Profiler(object):
+    """
+    Attributes the cost of Widget.draw_dirty() to widgets. While active,
+    the commands, command bytes, seconds spent waiting for replies and host
+    CPU seconds of each _draw() (or _update()) and fit_children() call are
+    accumulated per widget:
+
+        with widgets.Profiler() as profiler:
+            canvas.draw_dirty(display)
+        print profiler.report(canvas)
+
+    Inside Display.batch(), ACKs are mostly waited for when the batch ends,
+    outside of any widget. When no profiler is active, draw_dirty() only
+    tests a local variable per widget.
+    """
+
+    FIELDS = ('commands', 'bytes', 'wait', 'cpu')
+
+    def __init__(self):
+        self.costs = {}
+        self.started = None
+
+    def __enter__(self):
+        global PROFILER
+        PROFILER = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global PROFILER
+        PROFILER = None
+
+    def sample(self, display):
+        counters = display.counters
+        return (counters['commands'], counters['command_bytes'], counters['reply_wait'], time.clock())
+
+    def start(self, display):
+        self.started = self.sample(display)
+
+    def stop(self, display, widget, phase):
+        sample = self.sample(display)
+        costs = self.costs.setdefault(widget.id, {})
+        total = costs.get(phase, (0, 0, 0.0, 0.0))
+        costs[phase] = tuple(t + b - a for t, a, b in zip(total, self.started, sample))
+
+    def own(self, widget):
+        """
+        Return the costs of widget itself, summed over its phases.
+        """
+        costs = self.costs.get(widget.id, {}).values()
+        return tuple(sum(values) for values in zip((0, 0, 0.0, 0.0), *costs))
+
+    def totals(self, root):
+        """
+        Return a dictionary of widget id: costs including all descendants.
+        """
+        totals = {}
+        for widget in reversed(list(root.walk())):
+            totals[widget.id] = tuple(sum(values) for values in zip(self.own(widget), *[totals[child.id] for child in widget.children]))
+        return totals
+
+    def name(self, widget):
+        return '%s#%d' % (type(widget).__name__, widget.id)
+
+    def report(self, root, key='cpu'):
+        """
+        Return the widget tree as text, with the costs of each widget
+        including its descendants. Siblings are sorted by key, most
+        expensive first.
+        """
+        index = self.FIELDS.index(key)
+        totals = self.totals(root)
+        lines = ['%-40s %8s %8s %10s %10s' % ('widget', 'commands', 'bytes', 'wait ms', 'cpu ms')]
+        stack = [(root, 0)]
+        while stack:
+            widget, depth = stack.pop()
+            commands, size, wait, cpu = totals[widget.id]
+            lines.append('%-40s %8d %8d %10.3f %10.3f' % ('  ' * depth + self.name(widget), commands, size, wait * 1000, cpu * 1000))
+            children = sorted(widget.children, key=lambda child: totals[child.id][index])
+            stack.extend((child, depth + 1) for child in children)
+        return '\n'.join(lines)
+
+    def folded(self, root, key='cpu'):
+        """
+        Return the costs in the folded stack format read by flame graph
+        tools: one line per widget and phase, with its own cost. Times are
+        in microseconds.
+        """
+        index = self.FIELDS.index(key)
+        scale = 1000000 if key in ('wait', 'cpu') else 1
+        lines = []
+        stack = [(root, self.name(root))]
+        while stack:
+            widget, path = stack.pop()
+            for phase, costs in sorted(self.costs.get(widget.id, {}).items()):
+                value = int(round(costs[index] * scale))
+                if value:
+                    lines.append('%s;%s %d' % (path, phase, value))
+            stack.extend((child, path + ';' + self.name(child)) for child in reversed(widget.children))
+        return '\n'.join(lines)
+
+
+class TouchEvents(object):
+    """
+    Touch event stream of a Canvas. Touches are delivered to the innermost
+    interactive widget under them, with Widget.touch().
+
+    The touch detect region of the display is kept equal to the bounding
+    box of the visible interactive widgets, and reprogrammed after
+    draw_dirty() changes the layout, so the display ignores all other
+    touches. Call invalidate() after changing what is interactive without
+    changing the layout. While nothing interactive is visible, the display
+    is polled only every IDLE_INTERVAL seconds.
+    """
+
+    ACTIVE_INTERVAL = 0.02
+    IDLE_INTERVAL = 0.5
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.display = canvas.display
+        self.region = None
+        self.layouts = None
+        self.next_poll = 0
+        self.display.touch_Set(self.display.TOUCH_SET_MODE_INIT)
+
+    def invalidate(self):
+        self.layouts = None
+
+    def interactive_region(self):
+        """
+        Return the bounding box of the visible parts of all interactive
+        widgets, or None if there are none.
+        """
+        display = self.display
+        screen = None
+        if display.RES_X > 0 and display.RES_Y > 0:
+            screen = (0, 0, display.RES_X - 1, display.RES_Y - 1)
+        region = None
+        stack = [(self.canvas, screen)]
+        while stack:
+            widget, viewport = stack.pop()
+            visible = intersection(viewport, widget.envelope)
+            if visible is None:
+                continue
+            if widget.interactive():
+                if region is None:
+                    region = visible
+                else:
+                    region = (min(region[0], visible[0]), min(region[1], visible[1]),
+                            max(region[2], visible[2]), max(region[3], visible[3]))
+            stack.extend((child, visible) for child in widget.children)
+        return region
+
+    def update_region(self):
+        """
+        Program the touch detect region if the layout changed since it was
+        last computed.
+        """
+        if self.layouts == STORE.layouts:
+            return self.region
+        self.layouts = STORE.layouts
+        region = self.interactive_region()
+        if region is not None and region != self.region:
+            self.display.touch_DetectRegion(region[:2], region[2:])
+        self.region = region
+        return region
+
+    def target(self, point):
+        """
+        Return the innermost visible interactive widget at point, or None.
+        """
+        x, y = point
+        found = None
+        stack = [self.canvas]
+        while stack:
+            widget = stack.pop()
+            x1, y1, x2, y2 = widget.envelope
+            if not (x1 <= x <= x2 and y1 <= y <= y2):
+                continue
+            if widget.interactive():
+                found = widget
+            stack.extend(widget.children)
+        return found
+
+    def poll(self, now=None):
+        """
+        Read the touch status if a poll is due. Returns (status, point,
+        widget) for a touch, after delivering it to widget, or None.
+        """
+        if now is None:
+            now = time.time()
+        if now < self.next_poll:
+            return None
+        region = self.update_region()
+        self.next_poll = now + (self.ACTIVE_INTERVAL if region else self.IDLE_INTERVAL)
+        if region is None:
+            return None
+        display = self.display
+        status = display.touch_Get(display.TOUCH_GET_MODE_STATUS)
+        if status == display.TOUCH_STATUS_NOTOUCH:
+            return None
+        point = (display.touch_Get(display.TOUCH_GET_MODE_GET_X), display.touch_Get(display.TOUCH_GET_MODE_GET_Y))
+        widget = self.target(point)
+        if widget is not None:
+            widget.touch(status, point)
+        return (status, point, widget)
+
+    def __iter__(self):
+        """
+        Iterate over touch events forever, sleeping between polls.
+        """
+        while True:
+            event = self.poll()
+            if event:
+                yield event
+            else:
+                time.sleep(max(self.next_poll - time.time(), 0))
+
+
 class XGrid(Widget):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(XGrid, self).__init__(**kwargs)
         self.orientation = self.ORIENTATION_HORIZONTAL
@@ -132,6 +736,8 @@ class XGrid(Widget):
 
 class YGrid(Widget):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(YGrid, self).__init__(**kwargs)
         self.orientation = self.ORIENTATION_VERTICAL
@@ -139,6 +745,8 @@ class YGrid(Widget):
 
 class MatrixGrid(Widget):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(MatrixGrid, self).__init__(**kwargs)
         self.orientation = self.ORIENTATION_MATRIX
@@ -146,6 +754,10 @@ class MatrixGrid(Widget):
 
 class Button(Widget):
 
+    INTERACTIVE = True
+
+    __slots__ = ('background', 'foreground', 'text', 'text_envelope', 'char_height', 'char_width', 'char_size')
+
     def __init__(self, **kwargs):
         self.background = (1 << 16) - 1
         self.foreground = 0
@@ -175,3 +787,457 @@ class Button(Widget):
         display.gfx_Panel(display.PANEL_STATE_RAISED, self.envelope[:2], self.envelope[2]-self.envelope[0], self.envelope[3]-self.envelope[1], self.background)
         display.gfx_MoveTo(self.text_envelope)
         display.putStr(self.text)
+
+
+class ValueWidget(Widget):
+    """
+    Base class of widgets showing a value between minimum and maximum. The
+    value last drawn is tracked, and set_value() only repaints the parts
+    that the change of value affects, as drawn by _draw_delta().
+    """
+
+    __slots__ = ('value', 'minimum', 'maximum', 'background', 'foreground', 'drawn_value')
+
+    def __init__(self, **kwargs):
+        self.value = 0
+        self.minimum = 0
+        self.maximum = 100
+        self.background = 0
+        self.foreground = (1 << 16) - 1
+        self.drawn_value = None
+        super(ValueWidget, self).__init__(**kwargs)
+
+    def set_value(self, value):
+        value = min(max(value, self.minimum), self.maximum)
+        if value != self.value:
+            self.value = value
+            self.mark_updated()
+
+    def fraction(self, value):
+        if self.maximum == self.minimum:
+            return 0.0
+        return (value - self.minimum) / float(self.maximum - self.minimum)
+
+    def horizontal(self):
+        return self.width() >= self.height()
+
+    def length(self):
+        """
+        Return the size of the widget along its main axis, in pixels.
+        """
+        return (self.width() if self.horizontal() else self.height()) + 1
+
+    def pixel(self, index):
+        """
+        Return the coordinate of the pixel at index along the main axis.
+        Horizontal widgets grow to the right, vertical ones upwards.
+        """
+        if self.horizontal():
+            return self.envelope[0] + index
+        return self.envelope[3] - index
+
+    def position(self, value):
+        return self.pixel(int(round(self.fraction(value) * (self.length() - 1))))
+
+    def strip(self, display, a, b, colour):
+        """
+        Fill the strip between the main axis coordinates a and b, inclusive.
+        """
+        x1, y1, x2, y2 = self.envelope
+        a, b = min(a, b), max(a, b)
+        if self.horizontal():
+            a, b = max(a, x1), min(b, x2)
+            if a <= b:
+                display.gfx_RectangleFilled((a, y1), (b, y2), colour)
+        else:
+            a, b = max(a, y1), min(b, y2)
+            if a <= b:
+                display.gfx_RectangleFilled((x1, a), (x2, b), colour)
+
+    def _draw(self, display):
+        self._draw_value(display)
+        self.drawn_value = self.value
+
+    def _update(self, display):
+        if self.drawn_value is None:
+            return self._draw(display)
+        if self.value != self.drawn_value:
+            self._draw_delta(display, self.drawn_value, self.value)
+        self.drawn_value = self.value
+
+    def _draw_value(self, display):
+        raise NotImplementedError
+
+    def _draw_delta(self, display, old, new):
+        raise NotImplementedError
+
+
+class ProgressBar(ValueWidget):
+    """
+    A bar filled with the foreground colour up to its value. Updates cost
+    one gfx_RectangleFilled.
+    """
+
+    __slots__ = ()
+
+    def filled(self, value):
+        return int(round(self.fraction(value) * self.length()))
+
+    def _draw_value(self, display):
+        filled = self.filled(self.value)
+        if filled:
+            self.strip(display, self.pixel(0), self.pixel(filled - 1), self.foreground)
+        if filled < self.length():
+            self.strip(display, self.pixel(filled), self.pixel(self.length() - 1), self.background)
+
+    def _draw_delta(self, display, old, new):
+        old, new = self.filled(old), self.filled(new)
+        if old != new:
+            colour = self.foreground if new > old else self.background
+            self.strip(display, self.pixel(min(old, new)), self.pixel(max(old, new) - 1), colour)
+
+
+class Slider(ValueWidget):
+    """
+    A slider drawn on the host: a track in the background colour, and a
+    thumb of THUMB_SIZE pixels in the foreground colour. As the geometry is
+    known, updates move the thumb with at most two gfx_RectangleFilled.
+    Touching the track moves the thumb there.
+    """
+
+    INTERACTIVE = True
+    THUMB_SIZE = 8
+
+    __slots__ = ()
+
+    def thumb_size(self):
+        return min(self.THUMB_SIZE, self.length())
+
+    def thumb(self, value):
+        """
+        Return the index along the main axis of the first pixel of the thumb.
+        """
+        return int(round(self.fraction(value) * (self.length() - self.thumb_size())))
+
+    def value_at(self, point):
+        """
+        Return the value at point, a touch on the track.
+        """
+        x1, y1, x2, y2 = self.envelope
+        if self.horizontal():
+            index = point[0] - x1
+        else:
+            index = y2 - point[1]
+        fraction = min(max(index / float(max(self.length() - 1, 1)), 0.0), 1.0)
+        return self.minimum + int(round(fraction * (self.maximum - self.minimum)))
+
+    def touch(self, status, point):
+        if status in (self.display.TOUCH_STATUS_PRESS, self.display.TOUCH_STATUS_MOVING):
+            self.set_value(self.value_at(point))
+        super(Slider, self).touch(status, point)
+
+    def _draw_value(self, display):
+        start, size = self.thumb(self.value), self.thumb_size()
+        self.strip(display, self.pixel(0), self.pixel(self.length() - 1), self.background)
+        self.strip(display, self.pixel(start), self.pixel(start + size - 1), self.foreground)
+
+    def _draw_delta(self, display, old, new):
+        old, new, size = self.thumb(old), self.thumb(new), self.thumb_size()
+        if old == new:
+            return
+        # Erase what the thumb no longer covers, and draw what it newly does
+        if abs(new - old) >= size:
+            erase, draw = (old, old + size - 1), (new, new + size - 1)
+        elif new > old:
+            erase, draw = (old, new - 1), (old + size, new + size - 1)
+        else:
+            erase, draw = (new + size, old + size - 1), (new, old - 1)
+        self.strip(display, self.pixel(erase[0]), self.pixel(erase[1]), self.background)
+        self.strip(display, self.pixel(draw[0]), self.pixel(draw[1]), self.foreground)
+
+
+class Gauge(ValueWidget):
+    """
+    A round dial with a needle sweeping SWEEP degrees clockwise from
+    START_ANGLE. Updates erase the old needle and draw the new one, at a
+    cost of two gfx_Line.
+    """
+
+    START_ANGLE = 225
+    SWEEP = 270
+
+    __slots__ = ('needle',)
+
+    def __init__(self, **kwargs):
+        self.needle = 0b11111 << 11
+        super(Gauge, self).__init__(**kwargs)
+
+    def centre(self):
+        x1, y1, x2, y2 = self.envelope
+        return ((x1 + x2) / 2, (y1 + y2) / 2)
+
+    def radius(self):
+        return min(self.width(), self.height()) / 2
+
+    def tip(self, value):
+        angle = math.radians(self.START_ANGLE - self.SWEEP * self.fraction(value))
+        x, y = self.centre()
+        length = self.radius() - 2
+        return (x + int(round(length * math.cos(angle))), y - int(round(length * math.sin(angle))))
+
+    def _draw_value(self, display):
+        display.gfx_CircleFilled(self.centre(), self.radius(), self.background)
+        display.gfx_Circle(self.centre(), self.radius(), self.foreground)
+        display.gfx_Line(self.centre(), self.tip(self.value), self.needle)
+
+    def _draw_delta(self, display, old, new):
+        display.gfx_Line(self.centre(), self.tip(old), self.background)
+        display.gfx_Line(self.centre(), self.tip(new), self.needle)
+
+
+class LogView(Widget):
+    """
+    A scrolling view over lines of text. lines may be any sequence, so that
+    a host-side buffer of any size can back the view; only visible lines
+    are ever rendered.
+
+    Scrolling moves the rows still visible with gfx_ScreenCopyPaste, and
+    draws only the rows that were exposed. With follow set, append() keeps
+    the last line in view.
+    """
+
+    __slots__ = ('lines', 'offset', 'follow', 'background', 'char_size', 'drawn_offset', 'drawn_rows')
+
+    def __init__(self, **kwargs):
+        self.lines = []
+        self.offset = 0
+        self.follow = True
+        self.background = 0
+        self.char_size = None
+        self.drawn_offset = None
+        self.drawn_rows = 0
+        super(LogView, self).__init__(**kwargs)
+
+    def fit_children(self):
+        super(LogView, self).fit_children()
+        if not self.char_size:
+            self.char_size = (self.display.charwidth('e'), self.display.charheight('e'))
+        self.drawn_offset = None
+
+    def rows(self):
+        return (self.height() + 1) / self.char_size[1]
+
+    def visible_rows(self):
+        return max(min(self.rows(), len(self.lines) - self.offset), 0)
+
+    def append(self, line):
+        self.lines.append(line)
+        if self.follow and self.char_size:
+            self.scroll_to(len(self.lines) - self.rows())
+        self.mark_updated()
+
+    def scroll_to(self, offset):
+        offset = max(min(offset, len(self.lines) - 1), 0)
+        if offset != self.offset:
+            self.offset = offset
+            self.mark_updated()
+
+    def scroll_by(self, rows):
+        self.scroll_to(self.offset + rows)
+
+    def draw_rows(self, display, start, end):
+        """
+        Clear the rows from start to end, and draw their lines.
+        """
+        x1, y1, x2, y2 = self.envelope
+        width, height = self.char_size
+        columns = (x2 - x1 + 1) / width
+        for row in xrange(start, end):
+            y = y1 + row * height
+            display.gfx_RectangleFilled((x1, y), (x2, y + height - 1), self.background)
+            index = self.offset + row
+            if index < len(self.lines):
+                display.gfx_MoveTo((x1, y))
+                display.putStr(self.lines[index][:columns])
+
+    def _draw(self, display):
+        if self.follow:
+            self.offset = max(len(self.lines) - self.rows(), 0)
+        display.gfx_RectangleFilled(self.envelope[:2], self.envelope[2:], self.background)
+        self.drawn_offset = self.offset
+        self.drawn_rows = self.visible_rows()
+        self.draw_rows(display, 0, self.drawn_rows)
+
+    def _update(self, display):
+        if self.drawn_offset is None:
+            return self._draw(display)
+        rows = self.rows()
+        delta = self.offset - self.drawn_offset
+        if abs(delta) >= rows:
+            return self._draw(display)
+        x1, y1 = self.envelope[:2]
+        width = self.width() + 1
+        height = self.char_size[1]
+        drawn = self.drawn_rows
+        if delta > 0:
+            display.gfx_ScreenCopyPaste((x1, y1 + delta * height), (x1, y1), width, (rows - delta) * height)
+            drawn = max(drawn - delta, 0)
+        elif delta < 0:
+            # Copy downwards in strips no taller than the distance moved,
+            # starting at the bottom, so no strip overlaps its own destination.
+            top = rows + delta
+            while top > 0:
+                start = max(top + delta, 0)
+                display.gfx_ScreenCopyPaste((x1, y1 + start * height), (x1, y1 + (start - delta) * height), width, (top - start) * height)
+                top = start
+            self.draw_rows(display, 0, -delta)
+            drawn = min(drawn - delta, rows)
+        visible = self.visible_rows()
+        self.draw_rows(display, drawn, rows if delta > 0 else max(visible, drawn))
+        self.drawn_offset = self.offset
+        self.drawn_rows = visible
+
+
+# NumPy, imported by the first Chart that needs it.
+numpy = None
+
+
+def load_numpy():
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+    return numpy
+
+
+class Chart(Widget):
+    """
+    A streaming plot of a high-rate series. Blocks of samples pushed with
+    push() are reduced to one min/max pair per pixel column, vectorized with
+    NumPy, which is only imported once samples arrive. Each column covers
+    samples_per_column samples and is drawn as a vertical line between its
+    minimum and maximum.
+
+    Updates scroll the plot left with gfx_ScreenCopyPaste and draw only the
+    new columns. Only one column per pixel is kept, in a ring buffer, plus
+    the samples of the incomplete column.
+    """
+
+    __slots__ = ('minimum', 'maximum', 'samples_per_column', 'background', 'foreground',
+            'mins', 'maxs', 'head', 'count', 'carry', 'new_columns', 'drawn')
+
+    def __init__(self, **kwargs):
+        self.minimum = 0.0
+        self.maximum = 1.0
+        self.samples_per_column = 1
+        self.background = 0
+        self.foreground = (1 << 16) - 1
+        self.mins = None
+        self.maxs = None
+        self.head = 0
+        self.count = 0
+        self.carry = None
+        self.new_columns = 0
+        self.drawn = False
+        super(Chart, self).__init__(**kwargs)
+
+    def columns(self):
+        return self.width() + 1
+
+    def resize(self):
+        """
+        Size the ring buffer to the width of the widget, keeping the most
+        recent columns.
+        """
+        load_numpy()
+        mins, maxs = self.history()
+        columns = self.columns()
+        self.mins = numpy.zeros(columns)
+        self.maxs = numpy.zeros(columns)
+        self.head = 0
+        self.count = 0
+        if len(mins):
+            self.store(mins[-columns:], maxs[-columns:])
+        self.drawn = False
+
+    def fit_children(self):
+        super(Chart, self).fit_children()
+        # The ring buffer is first sized by push()
+        if self.mins is not None and len(self.mins) != self.columns():
+            self.resize()
+
+    def history(self):
+        """
+        Return the stored minima and maxima, oldest column first.
+        """
+        if self.mins is None:
+            return numpy.zeros(0), numpy.zeros(0)
+        order = (self.head - self.count + numpy.arange(self.count)) % len(self.mins)
+        return self.mins[order], self.maxs[order]
+
+    def store(self, mins, maxs):
+        size = len(self.mins)
+        mins, maxs = mins[-size:], maxs[-size:]
+        index = (self.head + numpy.arange(len(mins))) % size
+        self.mins[index] = mins
+        self.maxs[index] = maxs
+        self.head = (self.head + len(mins)) % size
+        self.count = min(self.count + len(mins), size)
+        self.new_columns = min(self.new_columns + len(mins), size)
+
+    def push(self, samples):
+        """
+        Append a block of samples, a NumPy array or any sequence.
+        """
+        load_numpy()
+        if self.mins is None:
+            self.resize()
+        samples = numpy.asarray(samples, dtype=float).ravel()
+        if self.carry is not None:
+            samples = numpy.concatenate((self.carry, samples))
+        n = self.samples_per_column
+        full = len(samples) - len(samples) % n
+        # Only the columns that fit on the widget are ever reduced
+        start = max(full - len(self.mins) * n, 0)
+        blocks = samples[start:full].reshape(-1, n)
+        self.carry = samples[full:]
+        if len(blocks):
+            self.store(blocks.min(axis=1), blocks.max(axis=1))
+            self.mark_updated()
+
+    def y(self, values):
+        """
+        Return the rows of values, clipped to the widget.
+        """
+        x1, y1, x2, y2 = self.envelope
+        span = float(self.maximum - self.minimum) or 1.0
+        rows = y2 - numpy.round((values - self.minimum) / span * (y2 - y1))
+        return numpy.clip(rows, y1, y2).astype(int)
+
+    def draw_columns(self, display, mins, maxs):
+        """
+        Draw columns at the right edge, the last one rightmost.
+        """
+        x = self.envelope[2] - len(mins) + 1
+        for column, (top, bottom) in enumerate(zip(self.y(maxs), self.y(mins))):
+            display.gfx_Line((x + column, int(top)), (x + column, int(bottom)), self.foreground)
+
+    def _draw(self, display):
+        display.gfx_RectangleFilled(self.envelope[:2], self.envelope[2:], self.background)
+        if self.mins is not None:
+            self.draw_columns(display, *self.history())
+        self.new_columns = 0
+        self.drawn = True
+
+    def _update(self, display):
+        new = self.new_columns
+        if not self.drawn or new >= self.columns():
+            return self._draw(display)
+        if not new:
+            return
+        x1, y1, x2, y2 = self.envelope
+        display.gfx_ScreenCopyPaste((x1 + new, y1), (x1, y1), self.columns() - new, y2 - y1 + 1)
+        display.gfx_RectangleFilled((x2 - new + 1, y1), (x2, y2), self.background)
+        mins, maxs = self.history()
+        self.draw_columns(display, mins[-new:], maxs[-new:])
+        self.new_columns = 0